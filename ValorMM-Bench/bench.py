@@ -4,16 +4,169 @@ ValorMM Benchmark Runner
 - Measures end-to-end HTTP latency and model latency from API response
 - Optionally captures peak_vram_mb if backend exposes it
 - Saves CSV to bench_out/results.csv
+- Load mode (--concurrency / --rate): many requests in flight, closed or open loop, optionally
+  streamed to measure time-to-first-token and inter-token latency
+- Every invocation is also stored as a run (see runstore.py): bench_out/runs/<time>[-tag]/ with
+  git commit, machine and config in meta.json, every request in requests.csv and p50/p95/p99 +
+  req/s per configuration in summary.csv; compare runs with compare.py
 Usage (examples):
   python bench.py --server http://127.0.0.1:8000 --image C:\path\img.jpg --rounds 3
   python bench.py --server http://127.0.0.1:8000 --pdf C:\path\file.pdf --tokens 128 256 384 512 --edges 640 768 1024
+  python bench.py --image C:\path\img.jpg --concurrency 1 2 4 8 --requests 40 --stream true
+  python bench.py --image C:\path\img.jpg --rate 0.5 1 2 --duration 120 --stream true --tag pr-123
 """
-import argparse, csv, os, time, datetime as dt, requests
+import argparse, csv, json, os, random, threading, time, uuid, datetime as dt, requests
+from concurrent.futures import ThreadPoolExecutor
+from runstore import Run, summarize
 
 def as_bool(x: str) -> bool:
     s = str(x).lower()
     return s in ("1","true","yes","y","on")
 
+def read_attachments(args):
+    # Read once as bytes; every request gets its own payload built from them
+    attachments = []
+    if args.image and os.path.exists(args.image):
+        with open(args.image, "rb") as f:
+            attachments.append((os.path.basename(args.image), f.read(), "image/jpeg"))
+    if args.pdf and os.path.exists(args.pdf):
+        with open(args.pdf, "rb") as f:
+            attachments.append((os.path.basename(args.pdf), f.read(), "application/pdf"))
+    return attachments
+
+def files_payload(attachments):
+    return [("files", (name, data, mime)) for name, data, mime in attachments] or None
+
+def send_one(args, attachments, edge, toks, stream):
+    """One chat request with a fresh payload; returns a per-request result row (times in ms)."""
+    form = {
+        "message": args.message if args.response_cache else f"{args.message} [{uuid.uuid4().hex[:8]}]",
+        "history": "[]",
+        "model_id": args.model_id,
+        "quant_4bit": str(bool(args.quant_4bit)).lower(),
+        "use_cpu": str(bool(args.use_cpu)).lower(),
+        "max_image_edge": str(int(edge)),
+        "max_new_tokens": str(int(toks)),
+        "use_response_cache": str(bool(args.response_cache)).lower(),
+    }
+    path = "/api/v1/chat/stream" if stream else "/api/v1/chat"
+    row = {"status": "", "http_ms": None, "ttft_ms": None, "itl_ms": [], "chunks": 0,
+           "completion_tokens": None, "model_latency_ms": None, "queue_wait_ms": None}
+    t0 = time.perf_counter()
+    try:
+        with requests.post(args.server.rstrip("/") + path, data=form, files=files_payload(attachments),
+                           timeout=args.timeout, stream=stream) as resp:
+            row["status"] = resp.status_code
+            if resp.status_code == 200 and stream:
+                usage = read_sse(resp, t0, row)
+            elif resp.status_code == 200:
+                usage = resp.json().get("usage", {})
+            else:
+                usage = {}
+        row["http_ms"] = (time.perf_counter() - t0) * 1000
+        row["completion_tokens"] = usage.get("completion_tokens")
+        row["model_latency_ms"] = usage.get("latency_ms")
+        row["queue_wait_ms"] = usage.get("queue_wait_ms")
+        if row["ttft_ms"] is None and usage.get("ttft_ms") is not None and not stream:
+            row["ttft_ms"] = usage["ttft_ms"]   # server-side TTFT when not streaming
+    except Exception as e:
+        row["http_ms"] = (time.perf_counter() - t0) * 1000
+        row["status"] = f"error:{type(e).__name__}"
+    return row
+
+def read_sse(resp, t0, row):
+    """Consumes an SSE answer, timestamping every data frame; returns the usage comment if sent."""
+    usage, buf, last = {}, "", None
+    for piece in resp.iter_content(chunk_size=None, decode_unicode=True):
+        now = time.perf_counter()
+        buf += piece
+        while "\n\n" in buf:
+            frame, buf = buf.split("\n\n", 1)
+            if frame.startswith(": usage "):
+                usage = json.loads(frame[len(": usage "):])
+            elif frame.startswith("data: ") and frame != "data: [DONE]":
+                if last is None:
+                    row["ttft_ms"] = (now - t0) * 1000
+                else:
+                    row["itl_ms"].append((now - last) * 1000)
+                last = now
+                row["chunks"] += 1
+    return usage
+
+def run_closed_loop(args, attachments, edge, toks, concurrency):
+    # `concurrency` users, each sending its next request as soon as the previous one finished
+    rows, lock = [], threading.Lock()
+    # --duration overrides --requests: only the deadline ends the run
+    budget = [float("inf") if args.duration else args.requests]
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def user():
+        while True:
+            with lock:
+                if budget[0] <= 0 or (deadline and time.perf_counter() > deadline):
+                    return
+                budget[0] -= 1
+            row = send_one(args, attachments, edge, toks, args.stream)
+            with lock:
+                rows.append(row)
+
+    threads = [threading.Thread(target=user) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return rows
+
+def run_open_loop(args, attachments, edge, toks, rate):
+    # Arrivals at `rate` req/s regardless of how fast the server answers (Poisson or fixed spacing);
+    # latency counts from the scheduled arrival, so a backed-up client does not hide queueing
+    n = args.requests if not args.duration else int(args.duration * rate)
+    gaps = [random.expovariate(rate) if args.arrival == "poisson" else 1.0 / rate for _ in range(n)]
+    def arrival(due):
+        # Time spent waiting for a free connection counts against the request
+        late_ms = max(0.0, time.perf_counter() - due) * 1000
+        row = send_one(args, attachments, edge, toks, args.stream)
+        row["http_ms"] += late_ms
+        if row["ttft_ms"] is not None:
+            row["ttft_ms"] += late_ms
+        return row
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.max_in_flight) as pool:
+        due = time.perf_counter()
+        for gap in gaps:
+            due += gap
+            time.sleep(max(0.0, due - time.perf_counter()))
+            futures.append(pool.submit(arrival, due))
+    return [f.result() for f in futures]
+
+def run_load(args, attachments, run):
+    if args.rate:
+        levels = [("open", r) for r in args.rate]
+    else:
+        levels = [("closed", c) for c in args.concurrency]
+    for edge in args.edges:
+        for toks in args.tokens:
+            for _ in range(args.warmup):
+                send_one(args, attachments, edge, toks, args.stream)
+            for mode, level in levels:
+                t0 = time.perf_counter()
+                if mode == "open":
+                    rows = run_open_loop(args, attachments, edge, toks, level)
+                else:
+                    rows = run_closed_loop(args, attachments, edge, toks, level)
+                summary = summarize(rows, time.perf_counter() - t0)
+                config = {"mode": mode, "level": level, "max_image_edge": edge, "max_new_tokens": toks,
+                          "stream": args.stream}
+                run.add_requests(config, rows)
+                run.add_summary(config, summary)
+                label = f"{level} users" if mode == "closed" else f"{level} req/s"
+                print(f"[LOAD] edge={edge} toks={toks} {label}: ok={summary['ok']}/{summary['requests']} "
+                      f"req/s={summary['req_per_s']} p50/p95/p99={summary['http_ms_p50']}/"
+                      f"{summary['http_ms_p95']}/{summary['http_ms_p99']} ms "
+                      f"ttft_p50={summary['ttft_ms_p50']} itl_p50={summary['itl_ms_p50']}")
+    print(f"\nSaved run: {run.path}")
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--server", default="http://127.0.0.1:8000", help="ValorMM backend base URL")
@@ -26,8 +179,28 @@ def main():
     ap.add_argument("--use_cpu", type=as_bool, default=False, help="Force CPU usage (True/False)")
     ap.add_argument("--message", default="Briefly describe this content.", help="Prompt message to use")
     ap.add_argument("--model_id", default="Qwen/Qwen2-VL-2B-Instruct", help="HF model id")
+    # Load mode
+    ap.add_argument("--concurrency", type=int, nargs="*", default=[], help="Closed loop: concurrent users to test")
+    ap.add_argument("--rate", type=float, nargs="*", default=[], help="Open loop: arrival rates (req/s) to test")
+    ap.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson", help="Open-loop arrival process")
+    ap.add_argument("--requests", type=int, default=20, help="Requests per load level")
+    ap.add_argument("--duration", type=float, default=0, help="Seconds per load level (overrides --requests)")
+    ap.add_argument("--max_in_flight", type=int, default=64, help="Open loop: client connection limit")
+    ap.add_argument("--warmup", type=int, default=1, help="Unmeasured requests before each configuration")
+    ap.add_argument("--stream", type=as_bool, default=False, help="Use /api/v1/chat/stream and measure TTFT / ITL")
+    ap.add_argument("--response_cache", type=as_bool, default=False,
+                    help="Allow server response-cache hits (default: every prompt is made unique)")
+    ap.add_argument("--timeout", type=float, default=600, help="Per-request timeout (s)")
+    ap.add_argument("--tag", default="", help="Label for this run (e.g. a branch or change name)")
     args = ap.parse_args()
 
+    attachments = read_attachments(args)
+    files_desc = [name for name, _, _ in attachments]
+    run = Run.create(args.tag, dict(vars(args), files=files_desc), args.server)
+    if args.concurrency or args.rate:
+        run_load(args, attachments, run)
+        return
+
     os.makedirs("bench_out", exist_ok=True)
     csv_path = os.path.join("bench_out", "results.csv")
     fieldnames = [
@@ -38,21 +211,16 @@ def main():
         with open(csv_path, "w", newline="", encoding="utf-8") as f:
             csv.DictWriter(f, fieldnames=fieldnames).writeheader()
 
-    files_payload = []
-    files_desc = []
-    if args.image and os.path.exists(args.image):
-        files_payload.append(("files", (os.path.basename(args.image), open(args.image, "rb"), "image/jpeg")))
-        files_desc.append(os.path.basename(args.image))
-    if args.pdf and os.path.exists(args.pdf):
-        files_payload.append(("files", (os.path.basename(args.pdf), open(args.pdf, "rb"), "application/pdf")))
-        files_desc.append(os.path.basename(args.pdf))
-
     target = args.server.rstrip("/") + "/api/v1/chat"
 
     with open(csv_path, "a", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames)
         for edge in args.edges:
             for toks in args.tokens:
+                # Unmeasured, so a model (re)load lands here and not in round 1
+                for _ in range(args.warmup):
+                    send_one(args, attachments, edge, toks, False)
+                rows, t_config = [], time.perf_counter()
                 for r in range(args.rounds):
                     form = {
                         "message": args.message,
@@ -62,10 +230,12 @@ def main():
                         "use_cpu": str(bool(args.use_cpu)).lower(),
                         "max_image_edge": str(int(edge)),
                         "max_new_tokens": str(int(toks)),
+                        # Repeated identical prompts would otherwise be answered from the response cache
+                        "use_response_cache": str(bool(args.response_cache)).lower(),
                     }
                     t0 = time.perf_counter()
                     try:
-                        resp = requests.post(target, data=form, files=files_payload if files_payload else None, timeout=600)
+                        resp = requests.post(target, data=form, files=files_payload(attachments), timeout=args.timeout)
                         http_ms = int((time.perf_counter() - t0)*1000)
                         status = resp.status_code
                         peak_vram = ""
@@ -100,6 +270,10 @@ def main():
                             "answer_chars": answer_chars,
                             "status": status
                         })
+                        rows.append({"round": r + 1, "status": status, "http_ms": http_ms,
+                                     "completion_tokens": usage.get("completion_tokens") if status == 200 else None,
+                                     "ttft_ms": usage.get("ttft_ms") if status == 200 else None,
+                                     "model_latency_ms": model_ms, "peak_vram_mb": peak_vram})
                         print(f"[OK] edge={edge} toks={toks} r={r+1}/{args.rounds} http_ms={http_ms} model_ms={model_ms} vram={peak_vram}")
                     except Exception as e:
                         http_ms = int((time.perf_counter() - t0)*1000)
@@ -118,7 +292,12 @@ def main():
                             "answer_chars": "",
                             "status": f"error:{e}"
                         })
+                        rows.append({"round": r + 1, "status": f"error:{e}", "http_ms": http_ms})
                         print(f"[ERR] edge={edge} toks={toks} r={r+1}/{args.rounds} error={e}")
+                config = {"mode": "sweep", "level": "", "max_image_edge": edge, "max_new_tokens": toks, "stream": False}
+                run.add_requests(config, rows)
+                run.add_summary(config, summarize(rows, time.perf_counter() - t_config))
     print(f"\nSaved CSV: {csv_path}")
+    print(f"Saved run: {run.path}")
 if __name__ == "__main__":
     main()
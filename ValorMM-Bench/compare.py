@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Compare two ValorMM Bench runs (see runstore.py)
+- For every configuration present in both runs: p50/p95/p99 of latency, TTFT and ITL, the
+  relative change and its bootstrap confidence interval (requests are resampled per run)
+- A change counts as a regression only when the whole interval is slower than --threshold %,
+  so run-to-run noise (warm-up, a model reload in one round) does not fail the check
+- Failed requests are left out of the percentiles, so the error rate is compared on its own: a
+  rise of more than --threshold percentage points is a regression too (a configuration whose
+  requests all fail fast must not pass as "faster")
+- Also prints the throughput change and warns when commit, machine or config differ
+- Exit code 1 if any regression
+Usage (examples):
+  python compare.py previous latest
+  python compare.py 20250101-120000-main pr-123 --threshold 5 --metrics http_ms ttft_ms
+"""
+import argparse, random, sys
+from collections import defaultdict
+from runstore import METRICS, PERCENTILES, config_key, find_run, metric_values, percentile
+
+
+def bootstrap_cis(base_rows, new_rows, metric, iterations, confidence, rng):
+    """{q: (low, high)}: confidence intervals (%) of the relative change of each percentile."""
+    deltas = {q: [] for q in PERCENTILES}
+    for _ in range(iterations):
+        b = metric_values([rng.choice(base_rows) for _ in base_rows], metric)
+        n = metric_values([rng.choice(new_rows) for _ in new_rows], metric)
+        if not b or not n:
+            continue
+        b.sort()
+        n.sort()
+        for q in PERCENTILES:
+            pb, pn = percentile(b, q), percentile(n, q)
+            if pb:
+                deltas[q].append((pn - pb) / pb * 100)
+    alpha = (1 - confidence) / 2 * 100
+    return {q: (percentile(d, alpha), percentile(d, 100 - alpha)) if d else (None, None) for q, d in deltas.items()}
+
+def describe(run):
+    meta = run.meta()
+    git = meta.get("git", {})
+    dirty = "+dirty" if git.get("dirty") else ""
+    return f"{run.id}  commit={git.get('commit', '')[:10]}{dirty}  host={meta.get('machine', {}).get('hostname', '')}"
+
+def meta_warnings(base, new):
+    a, b = base.meta(), new.meta()
+    out = []
+    if a.get("machine", {}).get("hostname") != b.get("machine", {}).get("hostname") or \
+            a.get("machine", {}).get("gpus") != b.get("machine", {}).get("gpus"):
+        out.append("runs come from different machines")
+    ignore = {"tag", "rounds", "requests", "duration", "warmup"}
+    ca, cb = a.get("config", {}), b.get("config", {})
+    changed = sorted(k for k in set(ca) | set(cb) if k not in ignore and ca.get(k) != cb.get(k))
+    if changed:
+        out.append("config differs in: " + ", ".join(changed))
+    return out
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("base", help="Baseline run: path, id, tag, 'previous' or 'latest'")
+    ap.add_argument("new", help="Run to check against the baseline")
+    ap.add_argument("--metrics", nargs="*", choices=METRICS, default=list(METRICS), help="Metrics to compare")
+    ap.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent")
+    ap.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the intervals")
+    ap.add_argument("--bootstrap", type=int, default=2000, help="Bootstrap resamples")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed (same seed, same intervals)")
+    args = ap.parse_args()
+
+    base, new = find_run(args.base), find_run(args.new)
+    print(f"base: {describe(base)}\nnew:  {describe(new)}")
+    for w in meta_warnings(base, new):
+        print(f"WARNING: {w}")
+
+    groups = {}
+    for name, run in (("base", base), ("new", new)):
+        rows, bad = run.requests()
+        if bad:
+            print(f"WARNING: {bad} unreadable row(s) in {run.id}/requests.csv were skipped")
+        by_config = defaultdict(list)
+        for r in rows:
+            by_config[config_key(r)].append(r)
+        groups[name] = by_config
+    throughput = {name: {config_key(s): s for s in run.summaries()} for name, run in (("base", base), ("new", new))}
+
+    rng = random.Random(args.seed)
+    regressions = []
+    common = [k for k in groups["base"] if k in groups["new"]]
+    for key in sorted(set(groups["base"]) ^ set(groups["new"])):
+        print(f"\n[{key}] only in {'base' if key in groups['base'] else 'new'} run, skipped")
+    for key in common:
+        b_rows, n_rows = groups["base"][key], groups["new"][key]
+        print(f"\n[{key}]  n={len(b_rows)} -> {len(n_rows)}")
+        tb, tn = throughput["base"].get(key), throughput["new"].get(key)
+        if tb and tn and float(tb["req_per_s"] or 0) > 0:
+            d = (float(tn["req_per_s"]) - float(tb["req_per_s"])) / float(tb["req_per_s"]) * 100
+            print(f"  {'req/s':<14} {float(tb['req_per_s']):>10.3f} -> {float(tn['req_per_s']):>10.3f}  {d:+7.1f}%")
+        b_err, n_err = (sum(r["status"] != 200 for r in rows) / len(rows) * 100 for rows in (b_rows, n_rows))
+        if b_err or n_err:
+            verdict = ""
+            if n_err - b_err > args.threshold:
+                verdict = "REGRESSION"
+                regressions.append(f"{key} errors")
+            print(f"  {'errors':<14} {b_err:>9.1f}% -> {n_err:>9.1f}%  {n_err - b_err:+7.1f} pts  {verdict}")
+        for metric in args.metrics:
+            if not metric_values(b_rows, metric) or not metric_values(n_rows, metric):
+                if metric_values(b_rows, metric) or metric_values(n_rows, metric):
+                    print(f"  {metric:<14} no successful requests in the {'new' if metric_values(b_rows, metric) else 'base'} run")
+                continue
+            cis = bootstrap_cis(b_rows, n_rows, metric, args.bootstrap, args.confidence, rng)
+            for q in PERCENTILES:
+                b = percentile(metric_values(b_rows, metric), q)
+                n = percentile(metric_values(n_rows, metric), q)
+                if not b:
+                    continue
+                lo, hi = cis[q]
+                delta = (n - b) / b * 100
+                verdict = ""
+                if lo is not None and lo > args.threshold:
+                    verdict = "REGRESSION"
+                    regressions.append(f"{key} {metric} p{q}")
+                elif hi is not None and hi < -args.threshold:
+                    verdict = "improved"
+                elif delta > args.threshold:
+                    verdict = "within noise"   # slower on paper, but the interval reaches below the threshold
+                ci = f"[{lo:+.1f}%, {hi:+.1f}%]" if lo is not None else "[n/a]"
+                print(f"  {metric + ' p' + str(q):<14} {b:>10.1f} -> {n:>10.1f}  {delta:+7.1f}%  "
+                      f"{int(args.confidence * 100)}% CI {ci:<20} {verdict}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold}%:")
+        for r in regressions:
+            print(f"  {r}")
+        sys.exit(1)
+    print(f"\nNo regression beyond {args.threshold}%")
+
+if __name__ == "__main__":
+    main()
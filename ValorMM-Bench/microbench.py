@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+ValorMM Microbenchmarks (offline: no server, no model download)
+- Times the CPU-side stages of the backend on synthetic inputs: image decode, resize, PDF
+  rasterization / ingestion, message building, stream decoding, and multipart parsing + SSE
+  through the FastAPI app with a tiny random Qwen2-VL standing in for the real model
+- Records median / min / max time and peak Python heap (tracemalloc) per stage and input size;
+  memory allocated inside native libraries (PIL, MuPDF, torch) is not part of that figure
+- Saves JSON to bench_out/micro/<name>.json and compares a run against a saved baseline
+Usage (examples):
+  python microbench.py --save baseline
+  python microbench.py --compare baseline --threshold 1.25
+  python microbench.py --only image pdf --repeat 10
+"""
+import argparse, io, json, os, platform, re, statistics, sys, time, tracemalloc, datetime as dt
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "backend")
+sys.path.insert(0, os.path.abspath(BACKEND))
+
+import torch
+from PIL import Image
+
+OUT_DIR = os.path.join("bench_out", "micro")
+IMAGE_SIZES = [(640, 480), (1920, 1080), (4032, 3024)]
+PDF_PAGES = [1, 4, 16]
+HISTORY_TURNS = [0, 10, 50]
+STREAM_TOKENS = [64, 256]
+
+# ---------------------------------------------------------------- synthetic inputs
+
+def make_image(size, fmt):
+    # Noise compresses like a photo, unlike a flat color
+    im = Image.effect_noise(size, 48).convert("RGB")
+    b = io.BytesIO()
+    im.save(b, fmt, quality=90) if fmt == "JPEG" else im.save(b, fmt)
+    return b.getvalue()
+
+def make_pdf(pages, scanned_every=3):
+    import fitz
+    doc = fitz.open()
+    photo = make_image((800, 600), "JPEG")
+    for i in range(pages):
+        page = doc.new_page()
+        if i % scanned_every == scanned_every - 1:
+            page.insert_image(page.rect, stream=photo)   # image-only page, like a scan
+        else:
+            text = f"Page {i + 1}. Invoice line items, totals and terms. " * 40
+            page.insert_textbox(fitz.Rect(48, 48, 560, 800), text, fontsize=10)
+    return doc.tobytes()
+
+# ---------------------------------------------------------------- stub model
+
+class StubTokenizer:
+    """Character-level tokenizer with Qwen2-VL's special tokens; enough for the chat pipeline."""
+    SPECIAL = {"<|image_pad|>": 290, "<|vision_start|>": 292, "<|vision_end|>": 293, "<|im_start|>": 294, "<|im_end|>": 295}
+    pad_token_id = 298
+    eos_token_id = 299
+    padding_side = "left"
+
+    def _encode(self, s):
+        ids = []
+        for part in re.split(r"(<\|[a-z_]+\|>)", s):
+            ids.extend([self.SPECIAL[part]] if part in self.SPECIAL else [ord(c) % 280 for c in part])
+        return ids
+
+    def __call__(self, prompts, padding=True, return_tensors="pt"):
+        enc = [self._encode(p) for p in prompts]
+        n = max(map(len, enc))
+        ids = torch.tensor([[self.pad_token_id] * (n - len(e)) + e for e in enc])
+        mask = torch.tensor([[0] * (n - len(e)) + [1] * len(e) for e in enc])
+        return {"input_ids": ids, "attention_mask": mask}
+
+    def convert_tokens_to_ids(self, token):
+        return self.SPECIAL[token]
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(97 + i % 26) if i % 7 else " " for i in ids if i < 280)
+
+class StubProcessor:
+    image_token = "<|image_pad|>"
+    model_input_names = ["input_ids", "attention_mask", "pixel_values", "image_grid_thw"]
+
+    def __init__(self):
+        from transformers import Qwen2VLImageProcessor
+        self.tokenizer = StubTokenizer()
+        self.image_processor = Qwen2VLImageProcessor(min_pixels=56 * 56, max_pixels=448 * 448)
+
+    def apply_chat_template(self, msgs, tokenize=False, add_generation_prompt=True):
+        s = ""
+        for m in msgs:
+            s += "<|im_start|>" + m["role"] + "\n"
+            for c in m["content"]:
+                s += "<|vision_start|><|image_pad|><|vision_end|>" if c["type"] == "image" else c["text"]
+            s += "<|im_end|>\n"
+        return s + "<|im_start|>assistant\n"
+
+def stub_model():
+    from transformers import Qwen2VLConfig, Qwen2VLForConditionalGeneration
+    torch.manual_seed(0)
+    cfg = Qwen2VLConfig(
+        text_config=dict(vocab_size=300, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096,
+                         rope_scaling={"type": "mrope", "mrope_section": [2, 3, 3]},
+                         eos_token_id=StubTokenizer.eos_token_id, pad_token_id=StubTokenizer.pad_token_id),
+        vision_config=dict(depth=1, embed_dim=32, hidden_size=64, num_heads=2, in_chans=3, patch_size=14,
+                           spatial_merge_size=2, temporal_patch_size=2),
+        image_token_id=290, video_token_id=291, vision_start_token_id=292)
+    model = Qwen2VLForConditionalGeneration(cfg).eval()
+    # Never stop early, so every run decodes exactly max_new_tokens
+    model.generation_config.eos_token_id = None
+    model.generation_config.pad_token_id = StubTokenizer.pad_token_id
+    return model
+
+def install_stub():
+    """Registers the stub under the default model key and returns a TestClient for the app."""
+    from app.config import settings
+    settings.preload_on_startup = False
+    settings.response_cache_budget_mb = 0
+    import app.services.vlm as vlm
+    model, processor = stub_model(), StubProcessor()
+    vlm._install_vision_cache(model)
+    vlm._load_processor = lambda model_id: processor
+    vlm._MODEL_REGISTRY.get((settings.model_id, settings.quant_4bit, settings.use_cpu), lambda: (model, processor))
+    from fastapi.testclient import TestClient
+    from app.main import app
+    return TestClient(app)
+
+# ---------------------------------------------------------------- measurement
+
+def measure(fn, repeat, warmup=1):
+    """Runs fn() warmup + repeat times; returns timing stats (ms) and peak traced heap (KiB)."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    # Memory from one extra run: tracing slows Python code down too much to time it as well
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"median_ms": round(statistics.median(times), 4), "min_ms": round(min(times), 4),
+            "max_ms": round(max(times), 4), "repeat": repeat, "peak_kb": round(peak / 1024, 1)}
+
+def bench_image(repeat, results):
+    from app.services.images import load_image_from_bytes, resize_long_edge
+    for w, h in IMAGE_SIZES:
+        for fmt in ("JPEG", "PNG"):
+            b = make_image((w, h), fmt)
+            for edge in (0, 1024):
+                results[f"image_decode/{fmt.lower()}-{w}x{h}/edge{edge}"] = measure(
+                    lambda: load_image_from_bytes(b, edge), repeat)
+        im = Image.open(io.BytesIO(make_image((w, h), "JPEG"))).convert("RGB")
+        results[f"resize_long_edge/{w}x{h}/edge1024"] = measure(lambda: resize_long_edge(im, 1024), repeat)
+
+def bench_pdf(repeat, results):
+    from app.services.pdf import pdf_ingest, pdf_to_images
+    for pages in PDF_PAGES:
+        pdf = make_pdf(pages)
+        results[f"pdf_to_images/{pages}p"] = measure(lambda: pdf_to_images(pdf), repeat)
+        def ingest():
+            _, sources, _ = pdf_ingest(pdf, 1024, mode="hybrid")
+            for s in sources:
+                s.load(1024)
+        results[f"pdf_ingest/hybrid-{pages}p"] = measure(ingest, repeat)
+
+def bench_msgs(repeat, results):
+    from app.services.vlm import build_msgs
+    images = [Image.new("RGB", (32, 32))] * 2
+    for turns in HISTORY_TURNS:
+        history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " * 30} for i in range(turns)]
+        results[f"build_msgs/{turns}turns"] = measure(lambda: build_msgs(history, "What changed?", images), repeat * 20)
+
+def bench_stream_decode(repeat, results):
+    import queue
+    from app.services.vlm import BatchStreamer
+    tokenizer = StubTokenizer()
+    for n in STREAM_TOKENS:
+        ids = torch.arange(n) % 280
+        def decode():
+            out = queue.Queue()
+            streamer = BatchStreamer(tokenizer, [out], [n], [StubTokenizer.eos_token_id])
+            streamer.put(torch.zeros(1, 8, dtype=torch.long))   # the prompt
+            for t in ids:
+                streamer.put(t.view(1))
+            streamer.end()
+        results[f"stream_decode/{n}tok"] = measure(decode, repeat)
+
+def bench_api(repeat, results):
+    import asyncio
+    from starlette.datastructures import Headers, UploadFile
+    client = install_stub()
+    from app.main import _read_uploads
+    form = {"message": "Describe the image.", "max_new_tokens": "1", "use_response_cache": "false"}
+    for w, h in IMAGE_SIZES:
+        b = make_image((w, h), "JPEG")
+        def read():
+            # The endpoint's upload read + hashing, timed here: the server's stages_ms is whole ms
+            f = UploadFile(io.BytesIO(b), filename="a.jpg", headers=Headers({"content-type": "image/jpeg"}))
+            asyncio.run(_read_uploads([f]))
+        results[f"multipart_read/jpeg-{w}x{h}"] = measure(read, repeat)
+        def chat():
+            r = client.post("/api/v1/chat", data=form, files={"files": ("a.jpg", b, "image/jpeg")})
+            r.raise_for_status()
+        # The whole request with a one-token answer: upload, decode, preprocess, prefill, JSON
+        results[f"chat_1tok/jpeg-{w}x{h}"] = measure(chat, repeat)
+    for n in STREAM_TOKENS:
+        data = dict(form, message="Tell a story.", max_new_tokens=str(n))
+        def stream():
+            text = client.post("/api/v1/chat/stream", data=data).text
+            assert text.rstrip().endswith("data: [DONE]")
+        results[f"sse_stream/{n}tok"] = measure(stream, repeat)
+
+SUITES = {"image": bench_image, "pdf": bench_pdf, "msgs": bench_msgs, "stream": bench_stream_decode, "api": bench_api}
+
+# ---------------------------------------------------------------- baselines
+
+def compare(current, baseline, threshold):
+    """Prints median ratios against a baseline; returns the keys slower than `threshold`x."""
+    regressions = []
+    for key, cur in sorted(current.items()):
+        base = baseline.get(key)
+        if base is None or not base["median_ms"]:
+            print(f"  {key:<48} {cur['median_ms']:>10.3f} ms   (new)")
+            continue
+        ratio = cur["median_ms"] / base["median_ms"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"  {key:<48} {cur['median_ms']:>10.3f} ms   x{ratio:.2f} vs {base['median_ms']:.3f}{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--only", nargs="*", choices=sorted(SUITES), help="Run only these suites")
+    ap.add_argument("--repeat", type=int, default=5, help="Measured repetitions per case")
+    ap.add_argument("--save", help="Save results as bench_out/micro/<name>.json")
+    ap.add_argument("--compare", help="Compare against bench_out/micro/<name>.json")
+    ap.add_argument("--threshold", type=float, default=1.25, help="Median slowdown that counts as a regression")
+    args = ap.parse_args()
+
+    torch.set_num_threads(1)   # stable numbers, independent of the machine's core count
+    results = {}
+    for name in args.only or list(SUITES):
+        print(f"[{name}]")
+        before = set(results)
+        SUITES[name](args.repeat, results)
+        for key in sorted(set(results) - before):
+            r = results[key]
+            print(f"  {key:<48} {r['median_ms']:>10.3f} ms  (min {r['min_ms']:.3f})  peak {r['peak_kb']:.0f} KiB")
+
+    run = {"meta": {"timestamp": dt.datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                    "platform": platform.platform(), "torch": torch.__version__, "repeat": args.repeat},
+           "results": results}
+    os.makedirs(OUT_DIR, exist_ok=True)
+    path = os.path.join(OUT_DIR, (args.save or "latest") + ".json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2)
+    print(f"\nSaved JSON: {path}")
+
+    if args.compare:
+        with open(os.path.join(OUT_DIR, args.compare + ".json"), encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        print(f"\nAgainst {args.compare}:")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) slower than x{args.threshold}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
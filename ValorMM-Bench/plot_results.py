@@ -1,21 +1,34 @@
 #!/usr/bin/env python3
 """
-Plot ValorMM Bench results (bench_out/results.csv) to PNGs under docs/
+Plot ValorMM Bench results to PNGs under docs/
+- Mean latency and VRAM from the legacy bench_out/results.csv
+- p50/p95/p99 and throughput per run from the run store (see runstore.py); several runs overlay
+  on one chart. The x axis is the load level for load runs and max_new_tokens for sweeps
+- Rows that do not parse are counted and reported, not dropped silently; failed requests are
+  reported too and left out of the latency means
+Usage (examples):
+  python plot_results.py
+  python plot_results.py --runs previous latest
 """
-import csv, os
+import argparse, csv, os
 from collections import defaultdict
 import matplotlib.pyplot as plt
+from runstore import CONFIG_FIELDS, METRICS, PERCENTILES, find_run, list_runs
 
 CSV_PATH = os.path.join("bench_out", "results.csv")
 DOCS_DIR = "docs"
 
 def load_rows():
-    rows = []
+    rows, bad, failed = [], 0, 0
     if not os.path.exists(CSV_PATH):
         print("No results.csv found. Run bench.py first.")
         return rows
     with open(CSV_PATH, newline="", encoding="utf-8") as f:
         for row in csv.DictReader(f):
+            if row.get("status") != "200":
+                # An error answers fast; averaged in, it would pass for a speed-up
+                failed += 1
+                continue
             try:
                 row["max_image_edge"] = int(row["max_image_edge"])
                 row["max_new_tokens"] = int(row["max_new_tokens"])
@@ -23,8 +36,12 @@ def load_rows():
                 row["model_latency_ms"] = int(row["model_latency_ms"]) if row["model_latency_ms"] != "" else None
                 row["peak_vram_mb"] = int(float(row["peak_vram_mb"])) if row["peak_vram_mb"] not in ("", None) else None
                 rows.append(row)
-            except Exception:
-                pass
+            except (KeyError, TypeError, ValueError):
+                bad += 1
+    if bad:
+        print(f"WARNING: skipped {bad} malformed row(s) in {CSV_PATH}")
+    if failed:
+        print(f"WARNING: skipped {failed} failed request(s) in {CSV_PATH}")
     return rows
 
 def plot_latency_vs_tokens(rows):
@@ -100,12 +117,100 @@ def plot_vram_vs_edge(rows):
     plt.savefig(out, bbox_inches="tight", dpi=160)
     print("Saved", out)
 
+def load_summaries(run):
+    rows, bad = [], 0
+    for row in run.summaries():
+        try:
+            row["x"] = float(row["level"]) if row["mode"] in ("closed", "open") else int(row["max_new_tokens"])
+            for k in ["req_per_s", "tokens_per_s"] + [f"{m}_p{q}" for m in METRICS for q in PERCENTILES]:
+                row[k] = float(row[k]) if row[k] != "" else None
+            rows.append(row)
+        except (KeyError, TypeError, ValueError):
+            bad += 1
+    if bad:
+        print(f"WARNING: skipped {bad} malformed row(s) in {run.id}/summary.csv")
+    return rows
+
+def run_series(runs):
+    """{(run label, series label, x label): [summary rows sorted by x]}; the series is every config field but x."""
+    out = defaultdict(list)
+    for run in runs:
+        for r in load_summaries(run):
+            load = r["mode"] in ("closed", "open")
+            x_field = "level" if load else "max_new_tokens"
+            xlabel = {"closed": "concurrent users", "open": "offered load (req/s)"}.get(r["mode"], "max_new_tokens")
+            series = " ".join(f"{k}={r[k]}" for k in CONFIG_FIELDS if k != x_field and r.get(k) not in ("", None))
+            out[(run.id if len(runs) > 1 else "", series, xlabel)].append(r)
+    return {k: sorted(v, key=lambda r: r["x"]) for k, v in out.items()}
+
+def plot_run_percentiles(series, suffix):
+    # One chart per metric: color per series, line style per percentile
+    styles = {50: "-", 95: "--", 99: ":"}
+    for m in METRICS:
+        plt.figure(figsize=(8,4.5))
+        drawn = False
+        for i, ((run_id, label, xlabel), items) in enumerate(sorted(series.items())):
+            color = f"C{i % 10}"
+            for q in PERCENTILES:
+                pts = [(r["x"], r[f"{m}_p{q}"]) for r in items if r[f"{m}_p{q}"] is not None]
+                if pts:
+                    plt.plot(*zip(*pts), marker="o", linestyle=styles[q], color=color,
+                             label=f"{run_id} {label} p{q}".strip())
+                    drawn = True
+            plt.xlabel(xlabel)
+        if drawn:
+            save_chart(f"{m} p50 / p95 / p99", f"{m} (ms)", f"perf-{m}-percentiles{suffix}.png")
+        else:
+            plt.close()
+
+def plot_run_throughput(series, suffix):
+    fig, axes = plt.subplots(1, 2, figsize=(11,4))
+    for i, ((run_id, label, xlabel), items) in enumerate(sorted(series.items())):
+        for ax, k in zip(axes, ("req_per_s", "tokens_per_s")):
+            ax.plot([r["x"] for r in items], [r[k] or 0 for r in items], marker="o", color=f"C{i % 10}",
+                    label=f"{run_id} {label}".strip())
+            ax.set_xlabel(xlabel)
+            ax.set_ylabel("requests / s" if k == "req_per_s" else "completion tokens / s")
+    axes[0].legend(fontsize=7)
+    fig.suptitle("Throughput")
+    os.makedirs(DOCS_DIR, exist_ok=True)
+    out = os.path.join(DOCS_DIR, f"perf-throughput{suffix}.png")
+    fig.savefig(out, bbox_inches="tight", dpi=160)
+    plt.close(fig)
+    print("Saved", out)
+
+def save_chart(title, ylabel, name):
+    plt.title(title)
+    plt.ylabel(ylabel)
+    plt.legend(fontsize=7)
+    os.makedirs(DOCS_DIR, exist_ok=True)
+    out = os.path.join(DOCS_DIR, name)
+    plt.savefig(out, bbox_inches="tight", dpi=160)
+    plt.close()
+    print("Saved", out)
+
 def main():
-    rows = load_rows()
-    if not rows:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", nargs="*", default=None,
+                    help="Runs to plot (id, tag, 'previous', 'latest'); default: the latest run")
+    args = ap.parse_args()
+
+    if args.runs is None:
+        rows = load_rows()
+        if rows:
+            plot_latency_vs_tokens(rows)
+            plot_latency_vs_edge(rows)
+            plot_vram_vs_edge(rows)
+        runs = list_runs()[-1:]
+    else:
+        runs = [find_run(r) for r in args.runs]
+    if not runs:
         return
-    plot_latency_vs_tokens(rows)
-    plot_latency_vs_edge(rows)
-    plot_vram_vs_edge(rows)
+    # Charts of one run are named after it; an overlay of several is "-compare"
+    suffix = f"-{runs[0].id}" if len(runs) == 1 else "-compare"
+    series = run_series(runs)
+    if series:
+        plot_run_percentiles(series, suffix)
+        plot_run_throughput(series, suffix)
 if __name__ == "__main__":
     main()
@@ -0,0 +1,162 @@
+"""
+ValorMM Bench run store
+- Every bench.py invocation is one run: bench_out/runs/<YYYYmmdd-HHMMSS>[-tag]/ holding
+  meta.json (git commit, machine, server, config), requests.csv (one row per request) and
+  summary.csv (one row per configuration)
+- Shared by bench.py, compare.py and plot_results.py
+"""
+import csv, glob, json, os, platform, socket, subprocess, datetime as dt
+
+RUNS_DIR = os.path.join("bench_out", "runs")
+CONFIG_FIELDS = ["mode", "level", "max_image_edge", "max_new_tokens", "stream"]
+REQUEST_FIELDS = CONFIG_FIELDS + ["round", "status", "http_ms", "ttft_ms", "itl_ms", "chunks",
+                                  "completion_tokens", "model_latency_ms", "queue_wait_ms", "peak_vram_mb"]
+METRICS = ("http_ms", "ttft_ms", "itl_ms")
+PERCENTILES = (50, 95, 99)
+SUMMARY_FIELDS = CONFIG_FIELDS + ["requests", "ok", "errors", "elapsed_s", "req_per_s", "tokens_per_s"] + \
+    [f"{m}_p{q}" for m in METRICS for q in PERCENTILES]
+
+
+def percentile(values, q):
+    """Linear-interpolated percentile (q in 0..100); None for no values."""
+    if not values:
+        return None
+    xs = sorted(values)
+    k = (len(xs) - 1) * q / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (k - lo)
+
+def metric_values(rows, metric):
+    # Successful requests only; ITL pools the gaps of every streamed answer
+    ok = [r for r in rows if r["status"] == 200]
+    if metric == "itl_ms":
+        return [x for r in ok for x in r.get("itl_ms") or []]
+    return [r[metric] for r in ok if r.get(metric) is not None]
+
+def summarize(rows, elapsed_s):
+    ok = [r for r in rows if r["status"] == 200]
+    toks = sum(r.get("completion_tokens") or 0 for r in ok)
+    out = {"requests": len(rows), "ok": len(ok), "errors": len(rows) - len(ok),
+           "elapsed_s": round(elapsed_s, 2),
+           "req_per_s": round(len(ok) / elapsed_s, 3) if elapsed_s > 0 else 0,
+           "tokens_per_s": round(toks / elapsed_s, 1) if elapsed_s > 0 else 0}
+    for m in METRICS:
+        values = metric_values(rows, m)
+        for q in PERCENTILES:
+            v = percentile(values, q)
+            out[f"{m}_p{q}"] = round(v, 1) if v is not None else ""
+    return out
+
+def config_key(row):
+    return " ".join(f"{k}={row[k]}" for k in CONFIG_FIELDS if row.get(k) not in ("", None))
+
+# ---------------------------------------------------------------- metadata
+
+def _run(cmd):
+    try:
+        return subprocess.run(cmd, capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        return ""
+
+def git_info():
+    here = os.path.dirname(os.path.abspath(__file__))
+    commit = _run(["git", "-C", here, "rev-parse", "HEAD"])
+    return {"commit": commit, "branch": _run(["git", "-C", here, "rev-parse", "--abbrev-ref", "HEAD"]),
+            "dirty": bool(_run(["git", "-C", here, "status", "--porcelain"])) if commit else None}
+
+def machine_info():
+    info = {"hostname": socket.gethostname(), "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "python": platform.python_version()}
+    gpus = _run(["nvidia-smi", "--query-gpu=name,memory.total,driver_version", "--format=csv,noheader"])
+    if gpus:
+        info["gpus"] = gpus.splitlines()
+    return info
+
+def server_info(server):
+    # Best effort: what the server reports about its warm-up and loaded models
+    import requests
+    out = {"url": server}
+    for name, path in (("ready", "/ready"), ("models", "/api/v1/models/cache")):
+        try:
+            out[name] = requests.get(server.rstrip("/") + path, timeout=5).json()
+        except Exception:
+            pass
+    return out
+
+# ---------------------------------------------------------------- runs
+
+class Run:
+    def __init__(self, path):
+        self.path = path
+        self.id = os.path.basename(os.path.normpath(path))
+
+    @classmethod
+    def create(cls, tag, config, server):
+        stamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RUNS_DIR, stamp + (f"-{tag}" if tag else ""))
+        os.makedirs(path, exist_ok=True)
+        run = cls(path)
+        meta = {"id": run.id, "tag": tag, "started": dt.datetime.now().isoformat(timespec="seconds"),
+                "git": git_info(), "machine": machine_info(), "server": server_info(server), "config": config}
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        for name, fields in (("requests.csv", REQUEST_FIELDS), ("summary.csv", SUMMARY_FIELDS)):
+            with open(os.path.join(path, name), "w", newline="", encoding="utf-8") as f:
+                csv.DictWriter(f, fieldnames=fields).writeheader()
+        return run
+
+    def add_requests(self, config, rows):
+        with open(os.path.join(self.path, "requests.csv"), "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=REQUEST_FIELDS, extrasaction="ignore")
+            for r in rows:
+                out = dict(config, **{k: ("" if v is None else v) for k, v in r.items()})
+                for k in ("http_ms", "ttft_ms"):
+                    # Failed requests have no TTFT (and a timed-out one may lack more)
+                    out[k] = round(out[k], 2) if out.get(k) not in ("", None) else ""
+                out["itl_ms"] = " ".join(f"{x:.2f}" for x in r.get("itl_ms") or [])
+                writer.writerow(out)
+
+    def add_summary(self, config, summary):
+        with open(os.path.join(self.path, "summary.csv"), "a", newline="", encoding="utf-8") as f:
+            csv.DictWriter(f, fieldnames=SUMMARY_FIELDS).writerow(dict(config, **summary))
+
+    def meta(self):
+        with open(os.path.join(self.path, "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def requests(self):
+        """Per-request rows with numbers parsed; returns (rows, number of rows that did not parse)."""
+        rows, bad = [], 0
+        with open(os.path.join(self.path, "requests.csv"), newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                try:
+                    row["status"] = int(row["status"]) if row["status"].isdigit() else row["status"]
+                    for k in ("http_ms", "ttft_ms", "completion_tokens"):
+                        row[k] = float(row[k]) if row[k] != "" else None
+                    row["itl_ms"] = [float(x) for x in row["itl_ms"].split()]
+                    rows.append(row)
+                except (KeyError, ValueError, AttributeError):
+                    bad += 1
+        return rows, bad
+
+    def summaries(self):
+        with open(os.path.join(self.path, "summary.csv"), newline="", encoding="utf-8") as f:
+            return list(csv.DictReader(f))
+
+def list_runs():
+    # Run ids start with their timestamp, so name order is time order
+    return [Run(p) for p in sorted(glob.glob(os.path.join(RUNS_DIR, "*"))) if os.path.isdir(p)]
+
+def find_run(ref):
+    """A run by path, id, unique id prefix / tag suffix, "latest" or "previous"."""
+    if os.path.isdir(ref):
+        return Run(ref)
+    runs = list_runs()
+    if ref in ("latest", "previous") and len(runs) >= (1 if ref == "latest" else 2):
+        return runs[-1] if ref == "latest" else runs[-2]
+    matches = [r for r in runs if r.id == ref] or [r for r in runs if r.id.startswith(ref) or r.id.endswith("-" + ref)]
+    if not matches:
+        raise SystemExit(f"No run matches {ref!r} under {RUNS_DIR}")
+    # A tag used more than once means its most recent run
+    return matches[-1]
@@ -1,4 +1,5 @@
-﻿from pydantic import BaseModel
+﻿from typing import List
+from pydantic import BaseModel
 
 class Settings(BaseModel):
     model_id: str = "Qwen/Qwen2-VL-2B-Instruct"
@@ -7,5 +8,73 @@ class Settings(BaseModel):
     device_map: str = "auto"
     max_image_edge: int = 1024
     max_new_tokens: int = 512
+    # CPU engine (use_cpu): "auto" (bf16 where supported, else int8), "int8", "bf16" or "fp32";
+    # thread counts (0 = torch default / all pinned cores), NUMA node to pin to (-1 = no pinning)
+    cpu_precision: str = "auto"
+    cpu_threads: int = 0
+    cpu_interop_threads: int = 0
+    cpu_numa_node: int = -1
+    cpu_compile: bool = False
+    # Startup: load these models (empty = model_id) and run a short dummy-image generation before /ready
+    preload_on_startup: bool = True
+    preload_models: List[str] = []
+    warmup_generate: bool = True
+    warmup_new_tokens: int = 8
+    # Assisted decoding ("", "prompt_lookup" or "draft"); greedy output is unchanged, runs at batch size 1
+    assist_mode: str = ""
+    prompt_lookup_tokens: int = 10
+    assistant_model_id: str = ""   # small text model sharing the tokenizer, e.g. Qwen/Qwen2-0.5B-Instruct
+    assistant_tokens: int = 5
+    # Visual tokens per request, shared by all its images / PDF pages (0 = only max_image_edge limits)
+    visual_token_budget: int = 4096
+    min_image_tokens: int = 64
+    # Prompt tokens per request (0 = unbounded): the oldest history turns are dropped to fit; the
+    # current message and its attachments are always kept
+    prompt_token_budget: int = 8192
+    # Loaded-model LRU: evict least recently used weights past either limit (0 = no limit)
+    model_cache_max_models: int = 2
+    model_cache_budget_mb: int = 3584
+    # Model workers: processes serving models behind the API process (0 = serve in-process). Devices
+    # ("cuda:N", "cpu", "cpu:<numa node>", "" = default) and preloaded models are assigned round-robin
+    model_workers: int = 0
+    worker_devices: List[str] = []
+    worker_models: List[str] = []
+    worker_health_interval_s: float = 5.0
+    worker_health_timeout_s: float = 30.0
+    # Inference executor: concurrent generations, waiting requests before 429, max queue wait before 503
+    inference_workers: int = 1
+    inference_queue_depth: int = 8
+    inference_queue_timeout_s: float = 120.0
+    # Server-side deadline per chat request from submission; generation stops there (0 = none)
+    request_deadline_s: float = 300.0
+    # Micro-batching: requests for the same model arriving within the wait window share one generate()
+    batch_max_size: int = 4
+    batch_max_wait_ms: int = 10
+    # Cross-turn KV reuse for requests that send a session_id (0 budget disables it)
+    prefix_cache_budget_mb: int = 512
+    prefix_cache_min_tokens: int = 16
+    # Vision cache: preprocessed pixels / encoder outputs in RAM, pixels optionally on disk ("" = off)
+    vision_cache_budget_mb: int = 512
+    vision_cache_dir: str = ""
+    vision_cache_disk_budget_mb: int = 2048
+    # Upload-once attachments ("" = <tmp>/valormm-attachments); unused files expire after the TTL
+    attachments_dir: str = ""
+    attachments_ttl_s: int = 3600
+    attachments_max_mb: int = 64
+    # PDF rasterization: pages rendered per PDF (0 = all), render processes (0 = render inline)
+    pdf_max_pages: int = 32
+    pdf_render_workers: int = 2
+    # PDF ingestion: "hybrid" (text layer for text pages, images for scans / figures), "image" or "text"
+    pdf_mode: str = "hybrid"
+    pdf_text_min_chars: int = 200
+    pdf_visual_coverage: float = 0.3
+    pdf_text_token_budget: int = 6000
+    # Response cache for identical greedy requests (0 budget disables it; "" dir = memory only)
+    response_cache_budget_mb: int = 64
+    response_cache_dir: str = ""
+    response_cache_disk_budget_mb: int = 512
+    # Image decode: threads decoding uploads in parallel; larger images are refused (decompression bombs)
+    image_decode_workers: int = 4
+    max_image_pixels: int = 64_000_000
 
 settings = Settings()
@@ -1,16 +1,46 @@
-﻿from fastapi import FastAPI, UploadFile, File, Form
+﻿from fastapi import FastAPI, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
 from typing import List, Optional
-import json
+import asyncio, json, time
 
 from .config import settings
 from .schemas import ChatResponse, Usage
-from .services.images import load_image_from_bytes
-from .services.inference import run_chat
-from .services.vlm import stream_chat_once
+from .services.images import ImageSource
+from .services.attachments import AttachmentNotFound, attachment_store
+from .services.executor import AdmissionError
+from .services.metrics import (REQUEST_SECONDS, Trace, merge_rendered, record, register_collector,
+                               render as render_metrics, stage)
+from .services.scheduler import InvalidRequest, RequestCancelled, aiter_stream
+from .services.workers import worker_pool
 
-app = FastAPI(title="ValorMM API", version="1.0.0")
+# In worker mode the model stack (torch, transformers, the caches) only loads in the workers
+if worker_pool.enabled:
+    register_collector("workers", worker_pool.stats)
+else:
+    from .services.inference import register_collectors
+    register_collectors()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if worker_pool.enabled:
+        # Models live in the worker processes; this one only parses and routes requests
+        worker_pool.start()
+        yield
+        worker_pool.stop()
+        return
+    from .services.cpu_engine import configure_cpu_runtime
+    from .services.warmup import start_warm_up, startup_state
+    # Pin threads / NUMA before anything spins up torch's pools or allocates weights
+    if settings.use_cpu:
+        configure_cpu_runtime()
+    # Warm-up runs in the background so /health and /ready answer while the weights load
+    start_warm_up(startup_state)
+    yield
+
+app = FastAPI(title="ValorMM API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,12 +50,158 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _stats(key: str):
+    # Worker mode: each worker's own numbers, since the API process holds no models or queues
+    if worker_pool.enabled:
+        return {"workers": [{"index": w["index"], **w["stats"][key]} for w in worker_pool.collect()]}
+    from .services.inference import local_stats
+    return local_stats()[key]
+
 @app.get("/health")
 def health():
     return {"ok": True}
 
+@app.get("/ready")
+def ready():
+    # 503 until the configured models are loaded and warmed up
+    if worker_pool.enabled:
+        state = {"ready": worker_pool.ready(), "workers": worker_pool.stats()["workers"]}
+    else:
+        from .services.warmup import startup_state
+        state = startup_state.snapshot()
+    return JSONResponse(state, status_code=200 if state["ready"] else 503)
+
+@app.get("/metrics")
+def metrics():
+    text = render_metrics()
+    if worker_pool.enabled:
+        text = merge_rendered([("", text)] + [(f'worker="{w["index"]}"', w["metrics"]) for w in worker_pool.collect()])
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+@app.get("/api/v1/queue")
+def queue_stats():
+    return _stats("queue")
+
+@app.get("/api/v1/workers")
+def workers():
+    return worker_pool.stats()
+
+@app.get("/api/v1/models/cache")
+def models_cache():
+    return _stats("models")
+
+@app.get("/api/v1/cache/prefix")
+def prefix_cache():
+    return _stats("prefix_cache")
+
+@app.get("/api/v1/cache/vision")
+def vision_cache():
+    return _stats("vision_cache")
+
+@app.post("/api/v1/attachments")
+async def upload_attachments(files: List[UploadFile] = File(...)):
+    try:
+        saved = [await attachment_store.save_upload(f) for f in files]
+        return {"attachments": saved}
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=413)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@app.get("/api/v1/cache/responses")
+def responses_cache():
+    return _stats("responses")
+
+@app.get("/api/v1/attachments/{att_id}")
+def get_attachment(att_id: str):
+    try:
+        return attachment_store.get(att_id, touch=False)
+    except AttachmentNotFound:
+        return JSONResponse({"error": f"unknown attachment id: {att_id}"}, status_code=404)
+
+@app.delete("/api/v1/attachments/{att_id}")
+def delete_attachment(att_id: str):
+    try:
+        attachment_store.delete(att_id)
+    except AttachmentNotFound:
+        return JSONResponse({"error": f"unknown attachment id: {att_id}"}, status_code=404)
+    return {"deleted": True}
+
+def _parse_history(history: str) -> list:
+    try:
+        hist = json.loads(history) if history else []
+        if not isinstance(hist, list): hist = []
+    except Exception:
+        hist = []
+    return hist
+
+def _decode_uploads(blobs):
+    imgs, pdfs = [], []
+    for name, content_type, b in blobs:
+        if name.lower().endswith(".pdf") or content_type.lower() == "application/pdf":
+            pdfs.append(b)
+        else:
+            # Hashed here, decoded by the worker only if the vision cache has not seen it
+            imgs.append(ImageSource.from_bytes(b))
+    return imgs, pdfs
+
+async def _read_uploads(files: Optional[List[UploadFile]]):
+    blobs = []
+    for f in files or []:
+        blobs.append((f.filename or "", f.content_type or "", await f.read()))
+    # Hashing (and any decoding) is CPU work; keep it off the event loop
+    return await run_in_threadpool(_decode_uploads, blobs)
+
+def _resolve_attachments(attachment_ids: str):
+    # Accepts a JSON list or a comma-separated string of ids returned by /api/v1/attachments
+    try:
+        ids = json.loads(attachment_ids) if attachment_ids.strip().startswith("[") else attachment_ids.split(",")
+    except Exception:
+        ids = attachment_ids.split(",")
+    attachment_store.sweep()
+    imgs, pdfs = [], []
+    for att_id in ids:
+        att_id = str(att_id).strip()
+        if att_id:
+            more_imgs, more_pdfs = attachment_store.resolve(att_id)
+            imgs.extend(more_imgs)
+            pdfs.extend(more_pdfs)
+    return imgs, pdfs
+
+def _submit_chat(**kwargs):
+    if worker_pool.enabled:
+        return worker_pool.submit_chat(**kwargs)
+    from .services.inference import submit_chat
+    return submit_chat(**kwargs)
+
+def _cancel_chat(request_id: str, reason: str = "client") -> bool:
+    if worker_pool.enabled:
+        return worker_pool.cancel_chat(request_id, reason)
+    from .services.inference import cancel_chat
+    return cancel_chat(request_id, reason)
+
+def _admission_error(e: AdmissionError) -> JSONResponse:
+    return JSONResponse({"error": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
+
+async def _await_job(request: Request, job, fut):
+    """Awaits one of the job's futures, cancelling the job if the client disconnects meanwhile."""
+    fut = asyncio.wrap_future(fut)
+    while True:
+        done, _ = await asyncio.wait({fut}, timeout=0.5)
+        if done:
+            return fut.result()
+        if await request.is_disconnected():
+            _cancel_chat(job.request_id, "disconnect")
+
+@app.post("/api/v1/chat/{request_id}/cancel")
+def cancel(request_id: str):
+    if not _cancel_chat(request_id):
+        return JSONResponse({"error": f"no running request {request_id}"}, status_code=404)
+    return {"cancelled": True}
+
 @app.post("/api/v1/chat", response_model=ChatResponse)
 async def chat(
+    request: Request,
     message: str = Form(""),
     history: str = Form("[]"),
     model_id: str = Form(settings.model_id),
@@ -33,38 +209,51 @@ async def chat(
     use_cpu: bool = Form(settings.use_cpu),
     max_image_edge: int = Form(settings.max_image_edge),
     max_new_tokens: int = Form(settings.max_new_tokens),
+    visual_token_budget: int = Form(settings.visual_token_budget),
+    session_id: str = Form(""),
+    attachment_ids: str = Form(""),
+    pdf_pages: str = Form(""),
+    pdf_mode: str = Form(settings.pdf_mode),
+    request_id: str = Form(""),
+    use_response_cache: bool = Form(True),
+    assist: str = Form(settings.assist_mode),
     files: Optional[List[UploadFile]] = File(None),
 ):
+    started = time.time()
+    trace = Trace()
     try:
-        try:
-            hist = json.loads(history) if history else []
-            if not isinstance(hist, list): hist = []
-        except Exception:
-            hist = []
-
-        imgs, pdfs = [], []
-        if files:
-            for f in files:
-                b = await f.read()
-                if f.filename.lower().endswith(".pdf") or (f.content_type or "").lower() == "application/pdf":
-                    pdfs.append(b)
-                else:
-                    try:
-                        imgs.append(load_image_from_bytes(b))
-                    except Exception:
-                        pass
-
-        answer, usage = run_chat(
+        hist = _parse_history(history)
+        with stage("multipart_read", [trace]):
+            imgs, pdfs = await _read_uploads(files)
+            if attachment_ids:
+                att_imgs, att_pdfs = await run_in_threadpool(_resolve_attachments, attachment_ids)
+                imgs.extend(att_imgs)
+                pdfs.extend(att_pdfs)
+
+        job = _submit_chat(
             model_id=model_id, quant_4bit=quant_4bit, use_cpu=use_cpu,
             max_image_edge=max_image_edge, max_new_tokens=max_new_tokens,
-            history=hist, message=message or "", images=imgs, pdfs=pdfs
+            history=hist, message=message or "", images=imgs, pdfs=pdfs, session_id=session_id,
+            pdf_pages=pdf_pages, pdf_mode=pdf_mode,
+            visual_token_budget=visual_token_budget, request_id=request_id, trace=trace,
+            use_cache=use_response_cache, assist=assist
         )
-        return ChatResponse(answer=answer, usage=Usage(**usage))
+        answer, usage = await _await_job(request, job, job.future)
+        usage["queue_wait_ms"] = job.queue_wait_ms
+        REQUEST_SECONDS.observe(time.time() - started)
+        return ChatResponse(answer=answer, usage=Usage(**usage), request_id=job.request_id)
+    except AdmissionError as e:
+        return _admission_error(e)
+    except (RequestCancelled, InvalidRequest) as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except AttachmentNotFound as e:
+        return JSONResponse({"error": f"unknown attachment id: {e.args[0]}"}, status_code=404)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @app.post("/api/v1/chat/stream")
 async def chat_stream(
+    request: Request,
     message: str = Form(""),
     history: str = Form("[]"),
     model_id: str = Form(settings.model_id),
@@ -72,44 +261,65 @@ async def chat_stream(
     use_cpu: bool = Form(settings.use_cpu),
     max_image_edge: int = Form(settings.max_image_edge),
     max_new_tokens: int = Form(settings.max_new_tokens),
+    visual_token_budget: int = Form(settings.visual_token_budget),
+    session_id: str = Form(""),
+    attachment_ids: str = Form(""),
+    pdf_pages: str = Form(""),
+    pdf_mode: str = Form(settings.pdf_mode),
+    request_id: str = Form(""),
+    use_response_cache: bool = Form(True),
+    assist: str = Form(settings.assist_mode),
     files: Optional[List[UploadFile]] = File(None),
 ):
     # Same parsing as /chat, but we return a streaming response (SSE-like)
+    started = time.time()
+    trace = Trace()
     try:
-        try:
-            hist = json.loads(history) if history else []
-            if not isinstance(hist, list): hist = []
-        except Exception:
-            hist = []
-
-        imgs, pdfs = [], []
-        if files:
-            for f in files:
-                b = await f.read()
-                if f.filename.lower().endswith(".pdf") or (f.content_type or "").lower() == "application/pdf":
-                    pdfs.append(b)
-                else:
-                    try:
-                        imgs.append(load_image_from_bytes(b))
-                    except Exception:
-                        pass
-
-        # Convert PDFs to images here to reuse vlm's streaming directly
-        if pdfs:
-            from .services.pdf import pdf_to_images
-            for pb in pdfs:
-                imgs.extend(pdf_to_images(pb))
-
-        def sse_iter():
-            for chunk in stream_chat_once(
-                model_id=model_id, quant_4bit=quant_4bit, use_cpu=use_cpu,
-                max_image_edge=max_image_edge, max_new_tokens=max_new_tokens,
-                history=hist, user_text=message or "", images=imgs
-            ):
-                # Simple text chunks; front-end will append directly
-                yield f"data: {chunk}\n\n"
-            yield "data: [DONE]\n\n"
-
-        return StreamingResponse(sse_iter(), media_type="text/event-stream")
+        hist = _parse_history(history)
+        with stage("multipart_read", [trace]):
+            imgs, pdfs = await _read_uploads(files)
+            if attachment_ids:
+                att_imgs, att_pdfs = await run_in_threadpool(_resolve_attachments, attachment_ids)
+                imgs.extend(att_imgs)
+                pdfs.extend(att_pdfs)
+
+        job = _submit_chat(
+            model_id=model_id, quant_4bit=quant_4bit, use_cpu=use_cpu,
+            max_image_edge=max_image_edge, max_new_tokens=max_new_tokens,
+            history=hist, message=message or "", images=imgs, pdfs=pdfs, stream=True,
+            session_id=session_id, pdf_pages=pdf_pages, pdf_mode=pdf_mode,
+            visual_token_budget=visual_token_budget, request_id=request_id, trace=trace,
+            use_cache=use_response_cache, assist=assist
+        )
+        # Hold the response until a worker takes the job so overload still maps to a status code
+        await _await_job(request, job, job.started)
+
+        async def sse_iter():
+            try:
+                async for chunk in aiter_stream(job):
+                    # Simple text chunks; front-end will append directly
+                    t0 = time.perf_counter()
+                    yield f"data: {chunk}\n\n"
+                    record("sse_write", time.perf_counter() - t0, [trace])
+                _, usage = job.future.result()
+                usage["queue_wait_ms"] = job.queue_wait_ms
+                usage["stages_ms"] = trace.as_dict()
+                REQUEST_SECONDS.observe(time.time() - started)
+                # SSE comment: clients that only read data: frames skip it
+                yield f": usage {json.dumps(usage)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                # Client closed the connection mid-answer: stop generating for it
+                if not job.future.done():
+                    _cancel_chat(job.request_id, "disconnect")
+
+        return StreamingResponse(sse_iter(), media_type="text/event-stream",
+                                 headers={"X-Queue-Wait-Ms": str(job.queue_wait_ms), "X-Request-Id": job.request_id})
+    except AdmissionError as e:
+        return _admission_error(e)
+    except (RequestCancelled, InvalidRequest) as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except AttachmentNotFound as e:
+        return JSONResponse({"error": f"unknown attachment id: {e.args[0]}"}, status_code=404)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
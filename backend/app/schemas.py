@@ -5,7 +5,29 @@ class Usage(BaseModel):
     prompt_tokens: int = 0
     completion_tokens: int = 0
     latency_ms: int = 0
+    ttft_ms: int = 0
+    decode_tokens_per_s: float = 0.0
+    assist_mode: str = ""
+    accepted_draft_tokens: int = 0
+    draft_acceptance_rate: float = 0.0
+    queue_wait_ms: int = 0
+    batch_size: int = 1
+    prefix_cache_hit: bool = False
+    cached_prompt_tokens: int = 0
+    image_cache_hits: int = 0
+    vision_embed_hits: int = 0
+    visual_tokens: int = 0
+    history_truncated: bool = False
+    history_turns_dropped: int = 0
+    history_tokens_dropped: int = 0
+    cancelled: bool = False
+    cancel_reason: str = ""
+    stages_ms: Dict[str, int] = {}
+    response_cache_hit: bool = False
+    pdf_text_pages: int = 0
+    pdf_image_pages: int = 0
 
 class ChatResponse(BaseModel):
     answer: str
     usage: Usage
+    request_id: str = ""
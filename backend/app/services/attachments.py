@@ -0,0 +1,188 @@
+﻿from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib, json, os, tempfile, threading, time
+
+from starlette.concurrency import run_in_threadpool
+
+from ..config import settings
+from .images import ImageSource
+from .pdf import pdf_ingest
+
+_CHUNK = 1024 * 1024
+
+
+class AttachmentNotFound(KeyError):
+    pass
+
+def _is_id(att_id: str) -> bool:
+    return len(att_id) == 64 and all(c in "0123456789abcdef" for c in att_id)
+
+
+class AttachmentStore:
+    """Uploads spooled to disk once and referenced by content id in later chat requests.
+
+    The id is the SHA-256 of the file, so re-uploading the same file is a no-op. After an upload
+    the images / PDF pages are preprocessed in the background into the vision cache, and files
+    that have not been used for `ttl_s` seconds are removed.
+    """
+
+    def __init__(self, root: str, ttl_s: int = 3600, max_mb: int = 64, prepare_workers: int = 1):
+        self.root = root
+        self.ttl_s = ttl_s
+        self.max_mb = max_mb
+        os.makedirs(root, exist_ok=True)
+        self._meta: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._prepare_pool = ThreadPoolExecutor(max_workers=prepare_workers, thread_name_prefix="attachments")
+        self._last_sweep = 0.0
+
+    def _path(self, att_id: str) -> str:
+        return os.path.join(self.root, att_id)
+
+    async def save_upload(self, upload) -> Dict[str, Any]:
+        """Streams an UploadFile to disk in chunks while hashing it; returns its metadata.
+
+        Hashing and file I/O run in the thread pool, so a large upload never blocks the event loop.
+        """
+        await run_in_threadpool(self.sweep)
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".part")
+        def write(chunk: bytes):
+            h.update(chunk)
+            out.write(chunk)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = await upload.read(_CHUNK)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self.max_mb > 0 and size > self.max_mb * 1024 * 1024:
+                        raise ValueError(f"{upload.filename}: attachment larger than {self.max_mb} MB")
+                    await run_in_threadpool(write, chunk)
+            att_id = h.hexdigest()
+            name = upload.filename or att_id
+            is_pdf = name.lower().endswith(".pdf") or (upload.content_type or "").lower() == "application/pdf"
+            meta = {"id": att_id, "name": name, "kind": "pdf" if is_pdf else "image", "size": size,
+                    "created": time.time(), "last_used": time.time(), "prepared": False}
+            return await run_in_threadpool(self._commit, tmp, meta)
+        finally:
+            # Still there only if the upload failed or was aborted; _commit moves it into place
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _commit(self, tmp: str, meta: Dict[str, Any]) -> Dict[str, Any]:
+        att_id = meta["id"]
+        os.replace(tmp, self._path(att_id))
+        with self._lock:
+            existing = self._meta.get(att_id)
+            if existing is not None:
+                existing["last_used"] = time.time()
+                return dict(existing)
+            self._meta[att_id] = meta
+            self._write_meta(meta)
+        # With model workers the caches live in the workers; warming this process would not help them
+        if settings.model_workers == 0:
+            self._prepare_pool.submit(self._prepare, att_id)
+        return dict(meta)
+
+    def get(self, att_id: str, touch: bool = True) -> Dict[str, Any]:
+        if not _is_id(att_id):
+            raise AttachmentNotFound(att_id)
+        with self._lock:
+            meta = self._meta.get(att_id)
+            if meta is None:
+                meta = self._read_meta(att_id)
+                if meta is not None:
+                    self._meta[att_id] = meta
+            if meta is None or not os.path.exists(self._path(att_id)):
+                raise AttachmentNotFound(att_id)
+            if touch:
+                meta["last_used"] = time.time()
+            return dict(meta)
+
+    def resolve(self, att_id: str) -> Tuple[List[ImageSource], List[Tuple[str, str]]]:
+        """(images, pdfs) for an attachment: an image source, or the PDF as (path, content id)."""
+        meta = self.get(att_id)
+        path = self._path(att_id)
+        if meta["kind"] == "pdf":
+            return [], [(path, att_id)]
+        return [ImageSource.from_file(path, att_id)], []
+
+    def _prepare(self, att_id: str):
+        # Decode / rasterize + preprocess now, so the first chat turn about this file finds it cached
+        from .vlm import preprocess_images
+        try:
+            images, pdfs = self.resolve(att_id)
+            for path, digest in pdfs:
+                images.extend(pdf_ingest(path, settings.max_image_edge, digest=digest)[1])
+            # Same per-image pixel cap as a chat turn sending just this attachment with default settings
+            preprocess_images(settings.model_id, images, settings.max_image_edge, settings.visual_token_budget)
+            with self._lock:
+                if att_id in self._meta:
+                    self._meta[att_id]["prepared"] = True
+        except Exception:
+            pass
+
+    def delete(self, att_id: str):
+        """Removes an attachment and its metadata; raises AttachmentNotFound for an unknown id."""
+        if not _is_id(att_id):
+            raise AttachmentNotFound(att_id)
+        with self._lock:
+            self._meta.pop(att_id, None)
+            removed = False
+            for p in (self._path(att_id), self._path(att_id) + ".json"):
+                if os.path.exists(p):
+                    os.remove(p)
+                    removed = True
+        if not removed:
+            raise AttachmentNotFound(att_id)
+
+    def sweep(self, force: bool = False):
+        """Drops attachments unused for longer than the TTL (at most once a minute unless forced).
+
+        Also removes temp files of uploads cut off by a crash that are older than the TTL.
+        """
+        now = time.time()
+        if not force and now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for name in os.listdir(self.root):
+            if name.endswith(".part"):
+                try:
+                    if now - os.path.getmtime(self._path(name)) > self.ttl_s:
+                        os.remove(self._path(name))
+                except OSError:
+                    pass   # finished (or removed) meanwhile
+                continue
+            if name.endswith(".json"):
+                continue
+            try:
+                meta = self.get(name, touch=False)
+            except AttachmentNotFound:
+                continue
+            if now - meta["last_used"] > self.ttl_s:
+                try:
+                    self.delete(name)
+                except AttachmentNotFound:
+                    pass   # removed concurrently
+
+    def _write_meta(self, meta: Dict[str, Any]):
+        with open(self._path(meta["id"]) + ".json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    def _read_meta(self, att_id: str) -> Optional[Dict[str, Any]]:
+        # Metadata survives restarts next to the file
+        try:
+            with open(self._path(att_id) + ".json", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+
+attachment_store = AttachmentStore(
+    root=settings.attachments_dir or os.path.join(tempfile.gettempdir(), "valormm-attachments"),
+    ttl_s=settings.attachments_ttl_s,
+    max_mb=settings.attachments_max_mb,
+)
@@ -0,0 +1,93 @@
+﻿from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+import hashlib, threading
+
+from ..config import settings
+from ..utils.tokens import rough_token_estimate
+
+# Chat-template framing per message (<|im_start|>role\n ... <|im_end|>\n) and per prompt
+# (default system message plus the generation prompt), in Qwen2-VL tokens
+_MESSAGE_OVERHEAD = 5
+_PROMPT_OVERHEAD = 20
+_MAX_COUNTS = 16384
+
+
+class TokenCounter:
+    """Token counts of message texts per tokenizer, memoized by content digest.
+
+    History is resent with every turn of a chat, so each message is tokenized once. Without a
+    tokenizer (or if it fails) the count falls back to rough_token_estimate.
+    """
+
+    def __init__(self, max_entries: int = _MAX_COUNTS):
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, tokenizer, text: str) -> int:
+        if not text:
+            return 0
+        key = (getattr(tokenizer, "name_or_path", "") or type(tokenizer).__name__,
+               hashlib.sha1(text.encode("utf-8")).digest())
+        with self._lock:
+            n = self._counts.get(key)
+            if n is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return n
+            self.misses += 1
+        try:
+            n = len(tokenizer.encode(text, add_special_tokens=False))
+        except Exception:
+            n = rough_token_estimate(text)
+        with self._lock:
+            self._counts[key] = n
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return n
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._counts), "hits": self.hits, "misses": self.misses}
+
+
+_COUNTER = TokenCounter()
+_STATS = {"compacted": 0, "turns_dropped": 0, "tokens_dropped": 0}
+_STATS_LOCK = threading.Lock()
+
+
+def compact_history(tokenizer, history: List[Dict[str, str]], user_text: str, visual_tokens: int,
+                    budget: int) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """The newest history turns that fit the prompt-token `budget` (0 = keep all), and what was dropped.
+
+    The current message and its images / PDF pages are always kept whole and count first; older
+    turns go before newer ones, and the kept history never starts with an assistant turn.
+    """
+    info = {"history_truncated": False, "history_turns_dropped": 0, "history_tokens_dropped": 0}
+    if budget <= 0 or not history:
+        return history, info
+    costs = [_COUNTER.count(tokenizer, h.get("content", "")) + _MESSAGE_OVERHEAD for h in history]
+    used = _PROMPT_OVERHEAD + _COUNTER.count(tokenizer, user_text) + _MESSAGE_OVERHEAD + visual_tokens
+    start = len(history)
+    while start > 0 and used + costs[start - 1] <= budget:
+        start -= 1
+        used += costs[start]
+    while start < len(history) and history[start].get("role") != "user":
+        start += 1
+    if start == 0:
+        return history, info
+    info.update(history_truncated=True, history_turns_dropped=start, history_tokens_dropped=sum(costs[:start]))
+    with _STATS_LOCK:
+        _STATS["compacted"] += 1
+        _STATS["turns_dropped"] += start
+        _STATS["tokens_dropped"] += info["history_tokens_dropped"]
+    return history[start:], info
+
+def context_stats() -> Dict[str, Any]:
+    with _STATS_LOCK:
+        out = dict(_STATS)
+    out["token_counts"] = _COUNTER.stats()
+    out["prompt_token_budget"] = settings.prompt_token_budget
+    return out
@@ -0,0 +1,124 @@
+﻿from typing import Any, Dict, List
+import logging, os, threading
+import torch
+try:
+    # optional; the supported home of dynamic int8 (torch.ao.quantization's is deprecated)
+    from torchao.quantization import Int8DynamicActivationInt8WeightConfig, quantize_
+except ImportError:
+    quantize_ = None
+
+from ..config import settings
+
+_PRECISIONS = ("auto", "int8", "bf16", "fp32")
+_LOCK = threading.Lock()
+_STATE: Dict[str, Any] = {}
+log = logging.getLogger(__name__)
+
+
+def _node_cpus(node: int) -> List[int]:
+    # cpulist looks like "0-15,32-47"
+    with open(f"/sys/devices/system/node/node{node}/cpulist") as f:
+        spec = f.read().strip()
+    cpus: List[int] = []
+    for part in filter(None, spec.split(",")):
+        lo, _, hi = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def configure_cpu_runtime() -> Dict[str, Any]:
+    """Pins the process to a NUMA node and sizes torch's thread pools; only the first call acts.
+
+    Runs before any weights load, so Linux first-touch allocation keeps them on the pinned node.
+    """
+    with _LOCK:
+        if _STATE:
+            return dict(_STATE)
+        pinned = 0
+        if settings.cpu_numa_node >= 0 and hasattr(os, "sched_setaffinity"):
+            try:
+                cpus = _node_cpus(settings.cpu_numa_node)
+                os.sched_setaffinity(0, cpus)
+                pinned = len(cpus)
+                _STATE["numa_node"] = settings.cpu_numa_node
+            except (OSError, ValueError) as e:
+                _STATE["numa_error"] = str(e)
+        threads = settings.cpu_threads or pinned
+        if threads > 0:
+            torch.set_num_threads(threads)
+        if settings.cpu_interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(settings.cpu_interop_threads)
+            except RuntimeError:
+                pass   # the inter-op pool already started; torch only allows this once, up front
+        _STATE["threads"] = torch.get_num_threads()
+        _STATE["interop_threads"] = torch.get_num_interop_threads()
+        _STATE["precision"] = cpu_precision()
+        _STATE["compile"] = settings.cpu_compile
+        return dict(_STATE)
+
+def _bf16_supported() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+def cpu_precision() -> str:
+    """The configured CPU precision, with "auto" resolved to bf16 where oneDNN supports it, else int8."""
+    precision = settings.cpu_precision
+    if precision not in _PRECISIONS:
+        raise ValueError(f"cpu_precision must be one of {', '.join(_PRECISIONS)}")
+    if precision == "auto":
+        return "bf16" if _bf16_supported() else "int8"
+    if precision == "int8" and "fbgemm" not in torch.backends.quantized.supported_engines \
+            and "qnnpack" not in torch.backends.quantized.supported_engines:
+        return "fp32"
+    return precision
+
+def cpu_load_dtype() -> torch.dtype:
+    # Dynamic int8 quantizes float32 Linear weights, so only bf16 loads in half precision
+    return torch.bfloat16 if cpu_precision() == "bf16" else torch.float32
+
+def _text_decoder(model) -> torch.nn.Module:
+    inner = getattr(model, "model", model)
+    return getattr(inner, "language_model", inner)
+
+def _quantize_int8(model):
+    # Weights of the decoder and LM head become int8; activations are quantized per call. The
+    # vision tower runs once per image and stays float32 to keep its accuracy.
+    head = getattr(model, "lm_head", None)
+    if quantize_ is not None:
+        quantize_(_text_decoder(model), Int8DynamicActivationInt8WeightConfig())
+        if isinstance(head, torch.nn.Linear):
+            quantize_(torch.nn.Sequential(head), Int8DynamicActivationInt8WeightConfig())
+        return
+    # Without torchao: the legacy API, as long as this torch still ships it
+    torch.ao.quantization.quantize_dynamic(_text_decoder(model), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if isinstance(head, torch.nn.Linear):
+        # quantize_dynamic only swaps children, so the head goes through a one-module wrapper
+        model.lm_head = torch.ao.quantization.quantize_dynamic(
+            torch.nn.Sequential(head), {torch.nn.Linear}, dtype=torch.qint8)[0]
+
+def optimize_for_cpu(model):
+    """Applies dynamic int8 quantization and optional torch.compile to a freshly loaded CPU model, in place.
+
+    If int8 is unavailable, the model runs in bf16 (where supported) or fp32 instead of failing to load.
+    """
+    if cpu_precision() == "int8":
+        try:
+            _quantize_int8(model)
+        except Exception as e:
+            fallback = "bf16" if _bf16_supported() else "fp32"
+            log.warning("int8 quantization failed (%s); running the model in %s", e, fallback)
+            if fallback == "bf16":
+                model.to(torch.bfloat16)
+            with _LOCK:
+                _STATE.update(precision=fallback, int8_fallback=True, int8_error=str(e))
+    if settings.cpu_compile:
+        # dynamic=True keeps one graph across prompt lengths instead of recompiling per shape
+        decoder = _text_decoder(model)
+        decoder.forward = torch.compile(decoder.forward, dynamic=True)
+    return model
+
+def cpu_engine_stats() -> Dict[str, Any]:
+    with _LOCK:
+        return dict(_STATE)
@@ -0,0 +1,122 @@
+﻿from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+import threading, time
+
+from ..config import settings
+
+
+class AdmissionError(RuntimeError):
+    """Request refused before it reached the model; `status_code` is the HTTP answer."""
+    status_code = 503
+
+class QueueFullError(AdmissionError):
+    status_code = 429
+
+class QueueTimeoutError(AdmissionError):
+    status_code = 503
+
+
+class InferenceJob:
+    def __init__(self):
+        self.future: Future = Future()   # result of the job function
+        self.started: Future = Future()  # resolves when a worker picks the job up
+        self.submitted_at = time.time()
+        self.started_at = None
+
+    @property
+    def queue_wait_ms(self) -> int:
+        end = self.started_at if self.started_at is not None else time.time()
+        return int((end - self.submitted_at) * 1000)
+
+
+class InferenceExecutor:
+    """Bounded worker pool for model calls.
+
+    At most `max_workers` jobs run at once and at most `max_queue` wait behind them; anything
+    beyond that is refused with QueueFullError instead of piling up. Jobs that sat in the queue
+    longer than `queue_timeout_s` are dropped with QueueTimeoutError when a worker reaches them.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queue: int = 8, queue_timeout_s: float = 0):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout_s = queue_timeout_s
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._closed = False
+        self.submitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> InferenceJob:
+        with self._lock:
+            if self._closed:
+                raise AdmissionError("Inference executor is shutting down")
+            if self._queued + self._running >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(
+                    f"Inference queue is full ({self._running} running, {self._queued} waiting); retry shortly"
+                )
+            self._queued += 1
+            self.submitted += 1
+        job = InferenceJob()
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job: InferenceJob, fn: Callable[..., Any], args, kwargs):
+        job.started_at = time.time()
+        with self._lock:
+            self._queued -= 1
+            expired = self.queue_timeout_s > 0 and job.started_at - job.submitted_at > self.queue_timeout_s
+            if expired:
+                self.timed_out += 1
+            else:
+                self._running += 1
+        if expired:
+            err = QueueTimeoutError(f"Request waited {job.queue_wait_ms} ms in the inference queue; server is overloaded")
+            job.started.set_exception(err)
+            job.future.set_exception(err)
+            return
+        job.started.set_result(job.queue_wait_ms)
+        try:
+            job.future.set_result(fn(*args, **kwargs))
+            ok = True
+        except BaseException as e:
+            job.future.set_exception(e)
+            ok = False
+        with self._lock:
+            self._running -= 1
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._closed = True
+        self._pool.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._queued,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+inference_executor = InferenceExecutor(
+    max_workers=settings.inference_workers,
+    max_queue=settings.inference_queue_depth,
+    queue_timeout_s=settings.inference_queue_timeout_s,
+)
@@ -1,14 +1,107 @@
-﻿from typing import List
+﻿from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 from io import BytesIO
+import hashlib, threading
 from PIL import Image, ImageOps
+from ..config import settings
 
-def load_image_from_bytes(b: bytes) -> Image.Image:
+_DECODE_POOL: Optional[ThreadPoolExecutor] = None
+_DECODE_LOCK = threading.Lock()
+
+def _decode_pool() -> Optional[ThreadPoolExecutor]:
+    # Pillow releases the GIL while decoding, so threads decode several uploads at once
+    global _DECODE_POOL
+    if settings.image_decode_workers <= 0:
+        return None
+    with _DECODE_LOCK:
+        if _DECODE_POOL is None:
+            _DECODE_POOL = ThreadPoolExecutor(max_workers=settings.image_decode_workers, thread_name_prefix="decode")
+        return _DECODE_POOL
+
+class ImageSource:
+    """An image identified by a content digest; pixels are decoded only when actually needed.
+
+    `loader(max_edge)` may decode at reduced size as long as the long edge stays >= max_edge
+    (0 = full size). `prefetch` starts that work in the background so a later `load` does not
+    wait for all of it; by default the loader runs on the decode thread pool.
+    """
+    def __init__(self, digest: str, loader: Callable[[int], Image.Image],
+                 prefetch: Optional[Callable[[int], None]] = None, kind: str = "image"):
+        self.digest = digest
+        self.kind = kind   # "image" or "pdf_page"
+        self._loader = loader
+        self._prefetch = prefetch
+        self._pending: Dict[int, Future] = {}
+        self._origin = None   # (constructor, args) for pickling, set by the from_* constructors
+
+    def load(self, max_edge: int = 0) -> Image.Image:
+        fut = self._pending.pop(max_edge, None)
+        return fut.result() if fut is not None else self._loader(max_edge)
+
+    def prefetch(self, max_edge: int = 0):
+        if self._prefetch is not None:
+            self._prefetch(max_edge)
+            return
+        pool = _decode_pool()
+        if pool is not None and max_edge not in self._pending:
+            self._pending[max_edge] = pool.submit(self._loader, max_edge)
+
+    def __reduce__(self):
+        # Crosses to model worker processes as the data it was built from
+        if self._origin is None:
+            raise TypeError("only ImageSource.from_bytes / from_file / from_image sources can be pickled")
+        return self._origin
+
+    @classmethod
+    def from_bytes(cls, b: bytes) -> "ImageSource":
+        src = cls(content_digest(b), lambda max_edge: load_image_from_bytes(b, max_edge))
+        src._origin = (ImageSource.from_bytes, (b,))
+        return src
+
+    @classmethod
+    def from_file(cls, path: str, digest: str) -> "ImageSource":
+        def load(max_edge: int):
+            with open(path, "rb") as f:
+                return load_image_from_bytes(f.read(), max_edge)
+        src = cls(digest, load)
+        src._origin = (ImageSource.from_file, (path, digest))
+        return src
+
+    @classmethod
+    def from_image(cls, im: Image.Image) -> "ImageSource":
+        im = im.convert("RGB")
+        src = cls(content_digest(im.tobytes(), f"{im.width}x{im.height}"), lambda max_edge: im,
+                  prefetch=lambda max_edge: None)
+        src._origin = (ImageSource.from_image, (im,))
+        return src
+
+def content_digest(b: bytes, salt: str = "") -> str:
+    h = hashlib.sha256(b)
+    if salt:
+        h.update(salt.encode("utf-8"))
+    return h.hexdigest()
+
+def load_image_from_bytes(b: bytes, max_edge: int = 0) -> Image.Image:
+    """Decodes an upload to RGB, auto-oriented; with `max_edge`, only at the size actually needed.
+
+    JPEGs are DCT-scaled while decoding (draft mode) and everything else is shrunk with a
+    reducing gap, so a phone photo never exists at full resolution when a 1024px edge will do.
+    """
     im = Image.open(BytesIO(b))
+    if settings.max_image_pixels > 0 and im.width * im.height > settings.max_image_pixels:
+        raise ValueError(f"Image has {im.width}x{im.height} pixels, over the {settings.max_image_pixels} limit")
+    if max_edge and max(im.size) > max_edge:
+        scale = max_edge / max(im.size)
+        # draft() keeps both sides >= the requested size, so the long edge cannot drop below max_edge
+        im.draft("RGB", (max(1, int(im.width * scale)), max(1, int(im.height * scale))))
     try:
         im = ImageOps.exif_transpose(im)  # auto-orient
     except Exception:
         pass
-    return im.convert("RGB")
+    im = im.convert("RGB")
+    if max_edge and max(im.size) > max_edge:
+        im.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=3.0)
+    return im
 
 def resize_long_edge(im: Image.Image, max_edge: int = 1024) -> Image.Image:
     w, h = im.size
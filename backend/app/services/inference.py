@@ -1,12 +1,213 @@
-﻿from typing import List, Dict
-from PIL import Image
-from .pdf import pdf_to_images
-from .vlm import chat_once
-
-def run_chat(model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int, max_new_tokens: int,
-             history: List[Dict[str,str]], message: str, images: List[Image.Image], pdfs: List[bytes]):
-    # Convert PDFs to images and extend
-    for pdf_bytes in pdfs:
-        images.extend(pdf_to_images(pdf_bytes))
-    # Call model
-    return chat_once(model_id, quant_4bit, use_cpu, max_image_edge, max_new_tokens, history, message, images)
+﻿from typing import Any, List, Dict, Optional
+import queue, re, threading, time
+from ..config import settings
+from .context import context_stats
+from .cpu_engine import cpu_engine_stats
+from .executor import inference_executor
+from .images import ImageSource, content_digest
+from .metrics import Trace, record, register_collector, stage
+from .pdf import pdf_ingest
+from .response_cache import ResponseCache, response_key
+from .scheduler import (_STREAM_END, BatchScheduler, ChatRequest, DuplicateRequestId, InvalidRequest,
+                        RequestCancelled, validate_chat)
+from .vlm import chat_batch, model_cache_stats, prefix_cache_stats, vision_cache_stats
+from .warmup import startup_state
+
+_ACTIVE: Dict[str, ChatRequest] = {}
+_ACTIVE_LOCK = threading.Lock()
+_INFLIGHT: Dict[str, ChatRequest] = {}   # response key -> request computing it (guarded by _ACTIVE_LOCK)
+_FOLLOWERS: Dict[str, ChatRequest] = {}  # request_id -> request waiting on an identical leader (same lock)
+_RESPONSE_CACHE = ResponseCache(settings.response_cache_budget_mb, settings.response_cache_dir,
+                                settings.response_cache_disk_budget_mb)
+
+def run_batch(batch: List[ChatRequest]):
+    # All requests in a batch share (model_id, quant_4bit, use_cpu)
+    head = batch[0]
+    try:
+        rows, live = [], []
+        for req in batch:
+            reason = req.check_cancel()
+            if reason:
+                # Gone before its turn came: do not spend a single forward pass on it
+                chat_scheduler.record_cancel(reason)
+                req.future.set_exception(RequestCancelled(f"Request {req.request_id} cancelled ({reason})"))
+                continue
+            images = list(req.images)
+            # PDFs: text layer for text pages, lazily rasterized images for scans / figures
+            texts, ingest = [], {"pdf_text_pages": 0, "pdf_image_pages": 0}
+            try:
+                for pdf in req.pdfs:
+                    pdf, digest = pdf if isinstance(pdf, tuple) else (pdf, None)
+                    with stage("pdf_ingest", [req.trace]):
+                        text, pages, counts = pdf_ingest(pdf, req.max_image_edge, req.pdf_pages, req.pdf_mode, digest=digest)
+                    if text:
+                        texts.append(text)
+                    images.extend(pages)
+                    for k, v in counts.items():
+                        ingest[k] += v
+            except Exception as e:
+                # Only this request fails; the rest of the batch still generates
+                req.future.set_exception(InvalidRequest(f"Unreadable PDF: {e}"))
+                continue
+            live.append(req)
+            user_text = "\n\n".join(texts + [req.message]) if texts else req.message
+            rows.append({"max_image_edge": req.max_image_edge, "max_new_tokens": req.max_new_tokens,
+                         "history": req.history, "user_text": user_text, "images": images, "out": req.out,
+                         "session_id": req.session_id, "ingest": ingest,
+                         "visual_token_budget": req.visual_token_budget, "cancelled": req.check_cancel,
+                         "trace": req.trace, "assist": req.assist})
+        if not live:
+            return
+        # Call model
+        results = chat_batch(head.model_id, head.quant_4bit, head.use_cpu, rows)
+        for req, result in zip(live, results):
+            if isinstance(result, BaseException):
+                req.future.set_exception(result)
+                continue
+            if result[1].get("cancelled"):
+                chat_scheduler.record_cancel(result[1]["cancel_reason"])
+            record("queue_wait", req.queue_wait_ms / 1000, [req.trace])
+            result[1]["stages_ms"] = req.trace.as_dict()
+            req.future.set_result(result)
+    finally:
+        for req in batch:
+            if req.out is not None:
+                req.out.put(_STREAM_END)
+
+chat_scheduler = BatchScheduler(
+    inference_executor, run_batch,
+    max_batch_size=settings.batch_max_size, max_wait_ms=settings.batch_max_wait_ms,
+)
+
+def submit_chat(model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int, max_new_tokens: int,
+                history: List[Dict[str,str]], message: str, images: List[ImageSource], pdfs: List,
+                stream: bool = False, session_id: str = "", pdf_pages: str = "", pdf_mode: str = "",
+                visual_token_budget: int = 0, request_id: str = "", trace: Trace = None,
+                use_cache: bool = True, assist: str = "") -> ChatRequest:
+    """Queues a chat turn for batched generation; raises AdmissionError when the server is saturated
+    and InvalidRequest for fields that cannot be served.
+
+    The request can be cancelled through cancel_chat(request_id) until it finishes, and stops on
+    its own after settings.request_deadline_s. Decoding is greedy, so an answer already in the
+    response cache is replayed instead, and an identical request already running is joined.
+    """
+    validate_chat(history, max_image_edge, max_new_tokens, pdf_pages, pdf_mode, assist)
+    deadline = time.time() + settings.request_deadline_s if settings.request_deadline_s > 0 else 0
+    req = ChatRequest(model_id, quant_4bit, use_cpu, max_image_edge, max_new_tokens, history, message,
+                      images, pdfs, out=queue.Queue() if stream else None, session_id=session_id,
+                      pdf_pages=pdf_pages, pdf_mode=pdf_mode, visual_token_budget=visual_token_budget,
+                      request_id=request_id, deadline=deadline, trace=trace, assist=assist)
+    key = _response_key(req) if use_cache and _RESPONSE_CACHE.enabled else None
+    if key is not None:
+        hit = _RESPONSE_CACHE.get(key)
+        if hit is not None:
+            return _replay(req, *hit)
+    with _ACTIVE_LOCK:
+        if req.request_id in _ACTIVE:
+            raise DuplicateRequestId(f"request_id {req.request_id} is already in use")
+        _ACTIVE[req.request_id] = req
+        leader = _INFLIGHT.get(key) if key is not None else None
+        if key is not None and leader is None:
+            _INFLIGHT[key] = req
+        elif leader is not None:
+            _FOLLOWERS[req.request_id] = req
+    req.future.add_done_callback(lambda f: _finish(req, key, f))
+    if leader is not None:
+        leader.future.add_done_callback(lambda f: _follow(req, f))
+        return req
+    try:
+        chat_scheduler.submit(req)
+    except BaseException as e:
+        req.future.set_exception(e)   # releases the key and the id
+        raise
+    return req
+
+def _response_key(req: ChatRequest) -> str:
+    images = [getattr(s, "digest", None) or ImageSource.from_image(s).digest for s in req.images]
+    pdfs = [p[1] if isinstance(p, tuple) else content_digest(p) for p in req.pdfs]
+    return response_key(
+        model=[req.model_id, req.quant_4bit, req.use_cpu], history=req.history, message=req.message,
+        images=images, pdfs=pdfs, max_image_edge=req.max_image_edge, max_new_tokens=req.max_new_tokens,
+        visual_token_budget=req.visual_token_budget, pdf_pages=req.pdf_pages, pdf_mode=req.pdf_mode or settings.pdf_mode,
+        # server-side knobs that change what the model sees
+        ingest=[settings.pdf_max_pages, settings.pdf_text_min_chars, settings.pdf_visual_coverage,
+                settings.pdf_text_token_budget, settings.min_image_tokens, settings.prompt_token_budget],
+    )
+
+def _replay(req: ChatRequest, answer: str, usage: Dict[str, Any]) -> ChatRequest:
+    """Completes `req` with a stored answer, streamed word by word when the request streams."""
+    usage = dict(usage, response_cache_hit=True, latency_ms=0, ttft_ms=0, decode_tokens_per_s=0.0,
+                 batch_size=1, stages_ms={}, queue_wait_ms=0)
+    req.started_at = time.time()
+    if not req.started.done():
+        req.started.set_result(0)
+    if req.out is not None:
+        for chunk in re.findall(r"\s*\S+", answer):
+            req.out.put(chunk)
+        req.out.put(_STREAM_END)
+    req.future.set_result((answer, usage))
+    return req
+
+def _follow(req: ChatRequest, leader):
+    # Identical request finished: reuse its answer unless it was cut short, then run our own
+    with _ACTIVE_LOCK:
+        if _FOLLOWERS.pop(req.request_id, None) is None:
+            return   # cancelled while waiting
+    if leader.exception() is None and not leader.result()[1].get("cancelled"):
+        _RESPONSE_CACHE.record_dedup()
+        _replay(req, *leader.result())
+        return
+    try:
+        chat_scheduler.submit(req)
+    except BaseException as e:
+        if not req.started.done():
+            req.started.set_exception(e)
+        req.future.set_exception(e)
+
+def _finish(req: ChatRequest, key: Optional[str], f):
+    if key is not None and f.exception() is None:
+        answer, usage = f.result()
+        if not usage.get("cancelled") and not usage.get("response_cache_hit"):
+            _RESPONSE_CACHE.put(key, answer, usage)
+    with _ACTIVE_LOCK:
+        if _ACTIVE.get(req.request_id) is req:
+            del _ACTIVE[req.request_id]
+        if key is not None and _INFLIGHT.get(key) is req:
+            del _INFLIGHT[key]
+
+def response_cache_stats() -> Dict[str, Any]:
+    return _RESPONSE_CACHE.stats()
+
+def cancel_chat(request_id: str, reason: str = "client") -> bool:
+    """Stops an in-flight request; False when no such request is queued or running."""
+    with _ACTIVE_LOCK:
+        req: Optional[ChatRequest] = _ACTIVE.get(request_id)
+        following = req is not None and _FOLLOWERS.pop(request_id, None) is req
+    if req is None:
+        return False
+    if following:
+        # Never queued: fail it here and leave the identical request it waited on running
+        req.cancel(reason)
+        chat_scheduler.record_cancel(reason)
+        chat_scheduler.fail(req, RequestCancelled(f"Request {req.request_id} cancelled ({reason})"))
+        return True
+    chat_scheduler.cancel(req, reason)
+    return True
+
+def local_stats() -> Dict[str, Any]:
+    """This process's queues and caches, as the stats endpoints report them."""
+    return {"queue": {"executor": inference_executor.stats(), "scheduler": chat_scheduler.stats()},
+            "models": model_cache_stats(), "prefix_cache": prefix_cache_stats(),
+            "vision_cache": vision_cache_stats(), "responses": response_cache_stats()}
+
+def register_collectors():
+    """Exports the model stack's stats on /metrics: the API process's, or a model worker's own."""
+    register_collector("executor", inference_executor.stats)
+    register_collector("scheduler", chat_scheduler.stats)
+    register_collector("model_cache", model_cache_stats)
+    register_collector("prefix_cache", prefix_cache_stats)
+    register_collector("vision_cache", vision_cache_stats)
+    register_collector("response_cache", response_cache_stats)
+    register_collector("cpu", cpu_engine_stats)
+    register_collector("context", context_stats)
+    register_collector("startup", lambda: {k: v for k, v in startup_state.snapshot().items() if k != "phases"})
@@ -0,0 +1,178 @@
+﻿from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+import bisect, sys, threading, time
+try:
+    import resource   # POSIX only; peak RSS
+except ImportError:
+    resource = None
+try:
+    import psutil     # optional; current RSS on every platform
+except ImportError:
+    psutil = None
+
+_STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with one series per label value."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = _STAGE_BUCKETS, label: str = ""):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series: Dict[str, Tuple[List[int], List[float]]] = {}   # label -> (bucket counts, [sum, count])
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label: str = ""):
+        with self._lock:
+            counts, total = self._series.setdefault(label, ([0] * len(self.buckets), [0.0, 0]))
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            total[0] += value
+            total[1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label, (counts, (total, n)) in sorted(self._series.items()):
+                base = f'{self.label}="{label}",' if self.label else ""
+                running = 0
+                for bound, c in zip(self.buckets, counts):
+                    running += c
+                    lines.append(f'{self.name}_bucket{{{base}le="{bound}"}} {running}')
+                lines.append(f'{self.name}_bucket{{{base}le="+Inf"}} {n}')
+                tags = f"{{{base.rstrip(',')}}}" if base else ""
+                lines.append(f"{self.name}_sum{tags} {total}")
+                lines.append(f"{self.name}_count{tags} {n}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("valormm_stage_seconds", "Time spent per request stage", label="stage")
+REQUEST_SECONDS = Histogram("valormm_request_seconds", "End-to-end chat request time")
+TTFT_SECONDS = Histogram("valormm_ttft_seconds", "Time from generate() start to the first new token")
+DECODE_TOKENS_PER_S = Histogram("valormm_decode_tokens_per_second", "Decode speed after the first token",
+                                buckets=_RATE_BUCKETS)
+_HISTOGRAMS = [STAGE_SECONDS, REQUEST_SECONDS, TTFT_SECONDS, DECODE_TOKENS_PER_S]
+_COLLECTORS: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+class Trace:
+    """Per-request stage timings in ms; stages that run more than once (per image, per chunk) add up."""
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, ms: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + ms
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {k: int(round(v)) for k, v in self.stages.items()}
+
+
+_CURRENT = threading.local()
+
+@contextmanager
+def tracing(traces: List[Trace]) -> Iterator[None]:
+    """Makes `traces` the target of stage() calls on this thread (a batch shares its stages)."""
+    previous = getattr(_CURRENT, "traces", None)
+    _CURRENT.traces = traces
+    try:
+        yield
+    finally:
+        _CURRENT.traces = previous
+
+def record(stage: str, seconds: float, traces: Optional[List[Trace]] = None):
+    STAGE_SECONDS.observe(seconds, stage)
+    for t in traces if traces is not None else (getattr(_CURRENT, "traces", None) or []):
+        t.add(stage, seconds * 1000)
+
+@contextmanager
+def stage(name: str, traces: Optional[List[Trace]] = None) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0, traces)
+
+def register_collector(prefix: str, fn: Callable[[], Dict[str, Any]]):
+    """Adds a stats() function whose numeric values are exported as `valormm_<prefix>_<key>` gauges."""
+    _COLLECTORS[prefix] = fn
+
+def _flatten(prefix: str, stats: Dict[str, Any]) -> Iterator[Tuple[str, float]]:
+    for k, v in stats.items():
+        if isinstance(v, bool):
+            yield f"{prefix}_{k}", int(v)
+        elif isinstance(v, (int, float)):
+            yield f"{prefix}_{k}", v
+        elif isinstance(v, dict):
+            yield from _flatten(f"{prefix}_{k}", v)
+
+def memory_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    if psutil is not None:
+        out["rss_bytes"] = psutil.Process().memory_info().rss
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        out["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    # Only when the model stack is loaded: a worker-mode API process never imports torch
+    torch = sys.modules.get("torch")
+    try:
+        if torch is not None and torch.cuda.is_available():
+            out["vram_allocated_bytes"] = torch.cuda.memory_allocated()
+            out["peak_vram_bytes"] = torch.cuda.max_memory_allocated()
+    except Exception:
+        pass
+    return out
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines: List[str] = []
+    for h in _HISTOGRAMS:
+        lines.extend(h.render())
+    for prefix, fn in list(_COLLECTORS.items()) + [("memory", memory_stats)]:
+        try:
+            stats = fn()
+        except Exception:
+            continue
+        for name, value in _flatten(f"valormm_{prefix}", stats):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def _labelled(sample: str, label: str) -> str:
+    head, value = sample.rsplit(" ", 1)
+    if head.endswith("}"):
+        i = head.index("{") + 1
+        return f"{head[:i]}{label},{head[i:]} {value}"
+    return f"{head}{{{label}}} {value}"
+
+def merge_rendered(parts: List[Tuple[str, str]]) -> str:
+    """Joins render() outputs of several processes into one exposition, each metric family once.
+
+    `parts` holds (label, text); a non-empty label such as 'worker="0"' is added to every sample
+    of that text, so the same histogram from different processes stays apart.
+    """
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for label, text in parts:
+        family = ""
+        for line in text.splitlines():
+            if line.startswith("# "):
+                kind, family = line.split(" ", 3)[1:3]
+                lines = headers.setdefault(family, [])
+                if not any(h.startswith(f"# {kind} ") for h in lines):
+                    lines.append(line)
+                samples.setdefault(family, [])
+            elif line:
+                samples.setdefault(family, []).append(_labelled(line, label) if label else line)
+    out: List[str] = []
+    for family, lines in samples.items():
+        out.extend(headers.get(family, []))
+        out.extend(lines)
+    return "\n".join(out) + "\n"
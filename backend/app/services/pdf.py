@@ -1,6 +1,174 @@
-﻿from typing import List
+﻿from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+import multiprocessing, os, tempfile, threading, weakref
 from PIL import Image
 import fitz  # PyMuPDF
+from ..config import settings
+from ..utils.tokens import rough_token_estimate
+from .images import ImageSource, content_digest
+
+PDF_MODES = ("hybrid", "image", "text")
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+
+def _render_pool() -> Optional[ProcessPoolExecutor]:
+    # PyMuPDF is not thread-safe, so parallel rasterization uses processes (0 workers = inline)
+    global _POOL
+    if settings.pdf_render_workers <= 0:
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: forking a process that runs threads (and CUDA) can deadlock the child
+            _POOL = ProcessPoolExecutor(max_workers=settings.pdf_render_workers,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _POOL
+
+def _open(pdf: Union[bytes, str]):
+    # Raw bytes from an upload, or the path of a spooled attachment
+    if isinstance(pdf, str):
+        return fitz.open(pdf, filetype="pdf")
+    return fitz.open(stream=pdf, filetype="pdf")
+
+def page_dpi(rect, max_edge: int, max_dpi: int = 144) -> int:
+    """Lowest DPI at which the page's long edge still reaches `max_edge` pixels (capped at `max_dpi`)."""
+    long_pt = max(rect.width, rect.height) or 1
+    return max(1, min(max_dpi, int(-(-max_edge * 72 // long_pt))))
+
+def parse_page_range(spec: str, page_count: int) -> List[int]:
+    """'1-3,7' -> [0, 1, 2, 6] (1-based, inclusive, clipped to the document); '' means all pages."""
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    pages: List[int] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        try:
+            start = int(lo) if lo.strip() else 1
+            end = int(hi) if hi.strip() else (start if not _ else page_count)
+        except ValueError:
+            raise ValueError(f"Invalid page range: {spec!r}")
+        for p in range(max(1, start), min(page_count, end) + 1):
+            if p - 1 not in pages:
+                pages.append(p - 1)
+    return pages
+
+def _render(pdf: Union[bytes, str], index: int, dpi: int):
+    # Runs in a worker process; returns raw RGB so only bytes cross the process boundary
+    pm = _open(pdf)[index].get_pixmap(dpi=dpi, alpha=False)
+    return pm.width, pm.height, pm.samples
+
+class _PdfRenderer:
+    """Renders pages of one PDF on the process pool, at most once each, on demand."""
+    def __init__(self, pdf: Union[bytes, str]):
+        self.pdf = pdf
+        self._futures: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+
+    def _pool_pdf(self) -> str:
+        # Caller holds self._lock. Workers get a path, not a copy of the whole document per page;
+        # written on the first page that needs rendering, so a fully cached PDF writes nothing
+        if isinstance(self.pdf, bytes):
+            fd, path = tempfile.mkstemp(suffix=".pdf")
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.pdf)
+            weakref.finalize(self, os.remove, path)
+            self.pdf = path
+        return self.pdf
+
+    def prefetch(self, index: int, dpi: int):
+        pool = _render_pool()
+        if pool is None:
+            return
+        with self._lock:
+            if index not in self._futures:
+                self._futures[index] = pool.submit(_render, self._pool_pdf(), index, dpi)
+
+    def load(self, index: int, dpi: int) -> Image.Image:
+        with self._lock:
+            fut = self._futures.pop(index, None)
+        w, h, samples = fut.result() if fut is not None else _render(self.pdf, index, dpi)
+        return Image.frombytes("RGB", (w, h), samples)
+
+def _digest(pdf: Union[bytes, str]) -> str:
+    if isinstance(pdf, str):
+        with open(pdf, "rb") as f:
+            return content_digest(f.read())
+    return content_digest(pdf)
+
+def _select(doc, pages: str, max_pages: Optional[int]) -> List[int]:
+    if max_pages is None:
+        max_pages = settings.pdf_max_pages
+    selected = parse_page_range(pages, doc.page_count)
+    return selected[:max_pages] if max_pages > 0 else selected
+
+def _page_sources(pdf: Union[bytes, str], doc, indices: List[int], max_edge: int, digest: str) -> List[ImageSource]:
+    renderer = _PdfRenderer(pdf)
+    sources = []
+    for i in indices:
+        dpi = page_dpi(doc[i].rect, max_edge)
+        sources.append(ImageSource(
+            f"{digest}:p{i}@{dpi}",
+            lambda max_edge, i=i, dpi=dpi: renderer.load(i, dpi),
+            prefetch=lambda max_edge, i=i, dpi=dpi: renderer.prefetch(i, dpi),
+            kind="pdf_page",
+        ))
+    return sources
+
+def classify_page(page) -> Tuple[str, str]:
+    """("text", text) when the page has a usable text layer and few images, else ("visual", text).
+
+    Scans have no (or almost no) text layer; pages dominated by figures / photos are visual
+    even when they carry captions.
+    """
+    text = page.get_text("text").strip()
+    area = abs(page.rect) or 1
+    covered = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    if len(text) >= settings.pdf_text_min_chars and covered / area < settings.pdf_visual_coverage:
+        return "text", text
+    return "visual", text
+
+def pdf_ingest(pdf: Union[bytes, str], max_edge: int = 1024, pages: str = "", mode: str = "",
+               max_pages: Optional[int] = None, digest: Optional[str] = None,
+               text_budget: Optional[int] = None) -> Tuple[str, List[ImageSource], Dict[str, int]]:
+    """Splits the selected pages into extracted text and page images: (text, sources, counts).
+
+    mode "hybrid" sends text pages as text and renders only visual pages, "image" renders every
+    page (the old behaviour), "text" sends only text. Extracted text is capped at `text_budget`
+    (estimated) tokens; text pages past it are cut and noted as truncated, visual pages after it
+    are still rendered.
+    """
+    mode = mode or settings.pdf_mode
+    if mode not in PDF_MODES:
+        raise ValueError(f"Unknown pdf_mode: {mode!r}")
+    if text_budget is None:
+        text_budget = settings.pdf_text_token_budget
+    doc = _open(pdf)
+    selected = _select(doc, pages, max_pages)
+    if mode == "image":
+        sources = _page_sources(pdf, doc, selected, max_edge, digest or _digest(pdf))
+        return "", sources, {"pdf_text_pages": 0, "pdf_image_pages": len(sources)}
+
+    parts, visual, used, full = [], [], 0, False
+    for i in selected:
+        kind, text = classify_page(doc[i])
+        if kind == "visual" and mode == "hybrid":
+            visual.append(i)
+            continue
+        if not text or full:
+            continue   # past the text budget, only visual pages are still collected
+        tokens = rough_token_estimate(text)
+        if text_budget > 0 and used + tokens > text_budget:
+            keep = max(0, (text_budget - used) * 4)
+            parts.append(f"[Page {i + 1}]\n{text[:keep]}\n[... truncated ...]")
+            full = True
+            continue
+        used += tokens
+        parts.append(f"[Page {i + 1}]\n{text}")
+    sources = _page_sources(pdf, doc, visual, max_edge, digest or _digest(pdf)) if visual else []
+    return "\n\n".join(parts), sources, {"pdf_text_pages": len(parts), "pdf_image_pages": len(sources)}
 
 def pdf_to_images(pdf_bytes: bytes, dpi: int = 144) -> List[Image.Image]:
     doc = fitz.open(stream=pdf_bytes, filetype="pdf")
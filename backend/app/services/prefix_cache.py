@@ -0,0 +1,76 @@
+﻿from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+import threading
+
+
+def common_prefix_len(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class PrefixCache:
+    """Per-session KV cache of the last prompt + answer, LRU-evicted under a memory budget.
+
+    A session holds at most one entry: the token ids fed through the model on its previous turn
+    and the matching past_key_values. `take` hands the entry out exclusively (it is extended in
+    place by generate), and the caller `put`s the grown cache back afterwards.
+    """
+
+    def __init__(self, budget_mb: int = 512, min_tokens: int = 16):
+        self.budget_mb = budget_mb
+        self.min_tokens = min_tokens    # shorter matches are not worth the bookkeeping
+        self._entries: "OrderedDict[Hashable, Tuple[List[int], Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    def take(self, key: Hashable, input_ids: List[int]) -> Tuple[Optional[Any], int]:
+        """Returns (cache, matched_len) for the longest cached prefix of `input_ids`, or (None, 0)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                tokens, cache, _ = entry
+                # Always leave at least one token to prefill so generate has logits to start from
+                matched = min(common_prefix_len(tokens, input_ids), len(input_ids) - 1)
+                if matched >= self.min_tokens:
+                    del self._entries[key]
+                    self.hits += 1
+                    self.reused_tokens += matched
+                    return cache, matched
+            self.misses += 1
+            return None, 0
+
+    def put(self, key: Hashable, tokens: List[int], cache: Any, nbytes: int):
+        budget = self.budget_mb * 1024 * 1024
+        if self.budget_mb <= 0 or nbytes > budget:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (tokens, cache, nbytes)
+            while self._resident_bytes() > budget:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def drop(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _resident_bytes(self) -> int:
+        return sum(nbytes for _, _, nbytes in self._entries.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "resident_mb": round(self._resident_bytes() / (1024 * 1024), 1),
+                "budget_mb": self.budget_mb,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+            }
@@ -0,0 +1,112 @@
+﻿from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+import threading, time
+
+
+class ModelRegistry:
+    """LRU cache of loaded models bounded by entry count and a memory budget (MB).
+
+    Loads are single-flight: concurrent first requests for the same key wait on one load
+    instead of each pulling its own copy of the weights.
+    """
+
+    def __init__(self, budget_mb: int = 0, max_entries: int = 0,
+                 size_of: Optional[Callable[[Any], int]] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.budget_mb = budget_mb          # 0 = unbounded
+        self.max_entries = max_entries      # 0 = unbounded
+        self._size_of = size_of or (lambda v: 0)
+        self._on_evict = on_evict
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}       # bytes, remembered across evictions
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Hashable, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_ms_total = 0
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                # Another caller finished loading while we waited on the key lock.
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key]
+                self.misses += 1
+                # Make room up front when we know (from a previous load) how big this entry is.
+                self._evict_for(key, self._sizes.get(key, 0))
+
+            t0 = time.time()
+            value = loader()
+            size = int(self._size_of(value) or 0)
+
+            with self._lock:
+                self.loads += 1
+                self.load_ms_total += int((time.time() - t0) * 1000)
+                self._entries[key] = value
+                self._sizes[key] = size
+                self._evict_for(key, 0)
+                self._key_locks.pop(key, None)
+            return value
+
+    def evict(self, key: Hashable) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._evict_one(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict_one(key)
+
+    def _resident_bytes(self) -> int:
+        return sum(self._sizes.get(k, 0) for k in self._entries)
+
+    def _evict_for(self, keep: Hashable, incoming_bytes: int):
+        # Caller holds self._lock. Never evicts `keep` itself.
+        budget = self.budget_mb * 1024 * 1024
+        while True:
+            victims = [k for k in self._entries if k != keep]
+            if not victims:
+                return
+            slots = len(self._entries) + (0 if keep in self._entries else 1)
+            over_count = self.max_entries > 0 and slots > self.max_entries
+            over_budget = budget > 0 and self._resident_bytes() + incoming_bytes > budget
+            if not (over_count or over_budget):
+                return
+            self._evict_one(victims[0])
+
+    def _evict_one(self, key: Hashable):
+        value = self._entries.pop(key)
+        self.evictions += 1
+        if self._on_evict is not None:
+            try:
+                self._on_evict(key, value)
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": [list(k) if isinstance(k, tuple) else k for k in self._entries],
+                "resident_mb": round(self._resident_bytes() / (1024 * 1024), 1),
+                "budget_mb": self.budget_mb,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "load_ms_total": self.load_ms_total,
+            }
@@ -0,0 +1,120 @@
+﻿from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import hashlib, json, os, threading
+
+from ..utils.disk import trim_dir
+
+
+def response_key(**parts: Any) -> str:
+    """Stable digest of everything that determines a greedy answer."""
+    blob = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Answers of finished greedy generations keyed by response_key().
+
+    The memory tier is an LRU bounded by `budget_mb`; with `disk_dir` set every answer is also
+    written there as JSON, so it survives restarts, and the oldest files are removed past
+    `disk_budget_mb`.
+    """
+
+    def __init__(self, budget_mb: int = 64, disk_dir: str = "", disk_budget_mb: int = 512):
+        self.budget_mb = budget_mb
+        self.disk_dir = disk_dir
+        self.disk_budget_mb = disk_budget_mb
+        self._entries: "OrderedDict[str, Tuple[str, Dict[str, Any], int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.deduplicated = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_mb > 0
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], dict(entry[1])
+        if self.disk_dir:
+            entry = self._load(key)
+            if entry is not None:
+                self._remember(key, *entry)
+                with self._lock:
+                    self.disk_hits += 1
+                return entry[0], dict(entry[1])
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, answer: str, usage: Dict[str, Any]):
+        self._remember(key, answer, usage)
+        if self.disk_dir:
+            self._save(key, answer, usage)
+
+    def record_dedup(self):
+        with self._lock:
+            self.deduplicated += 1
+
+    def _remember(self, key: str, answer: str, usage: Dict[str, Any]):
+        size = len(answer.encode("utf-8")) + len(json.dumps(usage))
+        budget = self.budget_mb * 1024 * 1024
+        if size > budget:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (answer, dict(usage), size)
+            self._bytes += size
+            while self._bytes > budget:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _load(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            os.utime(path)  # mark as recently used for disk eviction
+            return data["answer"], data["usage"]
+        except Exception:
+            return None
+
+    def _save(self, key: str, answer: str, usage: Dict[str, Any]):
+        path = self._path(key)
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"answer": answer, "usage": usage}, f)
+            os.replace(tmp, path)
+        except Exception:
+            return
+        trim_dir(self.disk_dir, ".json", self.disk_budget_mb * 1024 * 1024)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "resident_mb": round(self._bytes / (1024 * 1024), 2),
+                "budget_mb": self.budget_mb,
+                "disk_dir": self.disk_dir,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "deduplicated": self.deduplicated,
+            }
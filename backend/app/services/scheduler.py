@@ -0,0 +1,235 @@
+﻿from collections import deque
+from queue import Empty
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Hashable, List
+import asyncio, functools, threading, time, uuid
+
+from .executor import InferenceExecutor, InferenceJob
+from .metrics import Trace
+from .pdf import PDF_MODES, parse_page_range
+
+ASSIST_MODES = ("", "none", "prompt_lookup", "draft")
+_STREAM_END = object()   # closes a streaming request's `out` queue
+
+
+class RequestCancelled(RuntimeError):
+    """Request cancelled (client gone, cancel endpoint or deadline) before it produced anything."""
+    status_code = 499
+
+
+class InvalidRequest(ValueError):
+    """A request field (or upload) the model stack cannot use; answered with 400."""
+    status_code = 400
+
+
+class DuplicateRequestId(InvalidRequest):
+    """The client's request_id belongs to a request still running."""
+    status_code = 409
+
+
+def validate_chat(history: List[Dict[str, str]], max_image_edge: int, max_new_tokens: int,
+                  pdf_pages: str = "", pdf_mode: str = "", assist: str = ""):
+    """Raises InvalidRequest for fields that would otherwise fail inside a shared batch."""
+    if max_image_edge <= 0 or max_new_tokens <= 0:
+        raise InvalidRequest("max_image_edge and max_new_tokens must be positive")
+    if pdf_mode and pdf_mode not in PDF_MODES:
+        raise InvalidRequest(f"Unknown pdf_mode: {pdf_mode!r}")
+    if assist not in ASSIST_MODES:
+        raise InvalidRequest(f"Unknown assist mode: {assist!r}")
+    try:
+        parse_page_range(pdf_pages, 1)
+    except ValueError as e:
+        raise InvalidRequest(str(e)) from e
+    for h in history:
+        if not isinstance(h, dict) or not isinstance(h.get("role", ""), str) \
+                or not isinstance(h.get("content", ""), str):
+            raise InvalidRequest("history must be a list of {role, content} objects with string values")
+
+
+class ChatRequest(InferenceJob):
+    """One chat turn on its way through the batch scheduler.
+
+    `future` resolves to (answer, usage); when `out` is a queue the answer is also streamed
+    into it chunk by chunk. `pdfs` holds raw PDF bytes or (path, content id) of stored attachments.
+    Generation stops early once `cancel` was called or `deadline` (epoch seconds, 0 = none) passed.
+    """
+
+    def __init__(self, model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int, max_new_tokens: int,
+                 history: List[Dict[str, str]], message: str, images: List, pdfs: List[bytes], out=None,
+                 session_id: str = "", pdf_pages: str = "", pdf_mode: str = "", visual_token_budget: int = 0,
+                 request_id: str = "", deadline: float = 0, trace: Trace = None, assist: str = ""):
+        super().__init__()
+        self.model_id = model_id
+        self.quant_4bit = quant_4bit
+        self.use_cpu = use_cpu
+        self.max_image_edge = max_image_edge
+        self.max_new_tokens = max_new_tokens
+        self.history = history
+        self.message = message
+        self.images = images
+        self.pdfs = pdfs
+        self.out = out
+        self.session_id = session_id
+        self.pdf_pages = pdf_pages
+        self.pdf_mode = pdf_mode
+        self.visual_token_budget = visual_token_budget
+        self.request_id = request_id or uuid.uuid4().hex
+        self.deadline = deadline
+        self.cancel_reason = ""
+        self.trace = trace or Trace()
+        self.assist = assist
+        self.claimed = False
+
+    def cancel(self, reason: str):
+        if not self.cancel_reason:
+            self.cancel_reason = reason
+
+    def check_cancel(self) -> str:
+        """Why this request should stop ("" = keep going); polled by generate between tokens."""
+        if not self.cancel_reason and self.deadline and time.time() > self.deadline:
+            self.cancel_reason = "deadline"
+        return self.cancel_reason
+
+    @property
+    def batch_key(self) -> Hashable:
+        # Requests can share a generate() call only when they run on the same weights
+        return (self.model_id, self.quant_4bit, self.use_cpu)
+
+
+class BatchScheduler:
+    """Dynamic micro-batching on top of the inference executor.
+
+    Every request still takes an executor slot, so admission control and queue timeouts are
+    unchanged. The worker that picks a request up waits up to `max_wait_ms` for compatible
+    requests, then serves up to `max_batch_size` of them in one `run_batch` call; their own
+    executor jobs find them already claimed and return immediately. While a batch is running,
+    new arrivals collect in the pending queue and go out together as soon as a worker frees up.
+    """
+
+    def __init__(self, executor: InferenceExecutor, run_batch: Callable[[List[ChatRequest]], None],
+                 max_batch_size: int = 4, max_wait_ms: int = 10):
+        self.executor = executor
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self._pending: Dict[Hashable, Deque[ChatRequest]] = {}
+        self._cv = threading.Condition()
+        self.batches = 0
+        self.batched_requests = 0
+        self.max_batch_seen = 0
+        self.cancelled: Dict[str, int] = {}
+
+    def submit(self, req: ChatRequest) -> ChatRequest:
+        with self._cv:
+            # Admit first (may raise), then enqueue; the worker cannot look before we release the lock
+            job = self.executor.submit(self._serve, req)
+            self._pending.setdefault(req.batch_key, deque()).append(req)
+            self._cv.notify_all()
+        job.future.add_done_callback(lambda f: self._on_job_done(req, f))
+        return req
+
+    def _drop(self, req: ChatRequest) -> bool:
+        with self._cv:
+            queue = self._pending.get(req.batch_key)
+            if req.claimed or queue is None or req not in queue:
+                return False
+            queue.remove(req)
+            req.claimed = True
+            return True
+
+    def fail(self, req: ChatRequest, err: BaseException):
+        """Fails a request that will never reach run_batch (whose finally would close its stream)."""
+        if not req.started.done():
+            req.started.set_exception(err)
+        if not req.future.done():
+            req.future.set_exception(err)
+        if req.out is not None:
+            req.out.put(_STREAM_END)
+
+    def cancel(self, req: ChatRequest, reason: str):
+        """Marks `req` cancelled; a request still waiting for a batch is failed right away."""
+        req.cancel(reason)
+        if self._drop(req):
+            self.record_cancel(reason)
+            self.fail(req, RequestCancelled(f"Request {req.request_id} cancelled ({reason})"))
+
+    def record_cancel(self, reason: str):
+        with self._cv:
+            self.cancelled[reason] = self.cancelled.get(reason, 0) + 1
+
+    def _on_job_done(self, req: ChatRequest, f):
+        # The executor refused to run the job (queue timeout): fail the request unless a batch already took it
+        exc = f.exception()
+        if exc is not None and self._drop(req):
+            self.fail(req, exc)
+
+    def _collect(self, req: ChatRequest) -> List[ChatRequest]:
+        # Caller holds self._cv
+        queue = self._pending[req.batch_key]
+        deadline = time.time() + self.max_wait_ms / 1000.0
+        while not req.claimed and len(queue) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._cv.wait(remaining)
+        if req.claimed:
+            return []
+        queue.remove(req)
+        batch = [req]
+        while queue and len(batch) < self.max_batch_size:
+            batch.append(queue.popleft())
+        for r in batch:
+            r.claimed = True
+        return batch
+
+    def _serve(self, req: ChatRequest):
+        with self._cv:
+            batch = [] if req.claimed else self._collect(req)
+            if batch:
+                self.batches += 1
+                self.batched_requests += len(batch)
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        if not batch:
+            return
+
+        now = time.time()
+        for r in batch:
+            r.started_at = now
+            r.started.set_result(r.queue_wait_ms)
+        try:
+            self.run_batch(batch)
+        except BaseException as e:
+            for r in batch:
+                if not r.future.done():
+                    r.future.set_exception(e)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cv:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_ms,
+                "pending": sum(len(q) for q in self._pending.values()),
+                "batches": self.batches,
+                "batched_requests": self.batched_requests,
+                "avg_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0,
+                "max_batch_seen": self.max_batch_seen,
+                "cancelled": dict(self.cancelled),
+            }
+
+
+async def aiter_stream(req: InferenceJob) -> AsyncIterator[str]:
+    """Assistant text of a streaming request as it is generated; re-raises the request's error at the end."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            item = await loop.run_in_executor(None, functools.partial(req.out.get, timeout=0.5))
+        except Empty:
+            # The request may have been dropped before it ever ran (e.g. queue timeout)
+            if req.future.done() and req.out.empty():
+                break
+            continue
+        if item is _STREAM_END:
+            break
+        yield item
+    exc = req.future.exception()
+    if exc is not None:
+        raise exc
@@ -0,0 +1,118 @@
+﻿from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+import hashlib, os, threading
+import torch
+
+from ..utils.disk import trim_dir
+
+
+def _nbytes(value: Dict[str, torch.Tensor]) -> int:
+    return sum(t.nelement() * t.element_size() for t in value.values())
+
+
+class VisionCache:
+    """Content-addressed cache for vision inputs: preprocessed pixel tensors and encoder outputs.
+
+    Entries are dicts of CPU tensors. The memory tier is an LRU bounded by `budget_mb`; entries
+    put with `persist=True` are also written to `disk_dir` (when set) so they survive restarts,
+    with the oldest files removed past `disk_budget_mb`.
+    """
+
+    def __init__(self, budget_mb: int = 256, disk_dir: str = "", disk_budget_mb: int = 2048):
+        self.budget_mb = budget_mb
+        self.disk_dir = disk_dir
+        self.disk_budget_mb = disk_budget_mb
+        self._entries: "OrderedDict[Hashable, Dict[str, torch.Tensor]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key: Hashable, persist: bool = False) -> Optional[Dict[str, torch.Tensor]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if persist and self.disk_dir:
+            value = self._load(key)
+            if value is not None:
+                self._remember(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Presence check without touching LRU order or hit counters
+        with self._lock:
+            if key in self._entries:
+                return True
+        return bool(self.disk_dir) and os.path.exists(self._path(key))
+
+    def put(self, key: Hashable, value: Dict[str, torch.Tensor], persist: bool = False):
+        value = {k: v.detach().cpu() for k, v in value.items()}
+        self._remember(key, value)
+        if persist and self.disk_dir:
+            self._save(key, value)
+
+    def _remember(self, key: Hashable, value: Dict[str, torch.Tensor]):
+        size = _nbytes(value)
+        budget = self.budget_mb * 1024 * 1024
+        if size > budget:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _nbytes(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > budget:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _nbytes(evicted)
+                self.evictions += 1
+
+    def _path(self, key: Hashable) -> str:
+        name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, name + ".pt")
+
+    def _load(self, key: Hashable) -> Optional[Dict[str, torch.Tensor]]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            value = torch.load(path, map_location="cpu")
+            os.utime(path)  # mark as recently used for disk eviction
+            return value
+        except Exception:
+            return None
+
+    def _save(self, key: Hashable, value: Dict[str, torch.Tensor]):
+        path = self._path(key)
+        try:
+            tmp = path + ".tmp"
+            torch.save(value, tmp)
+            os.replace(tmp, path)
+        except Exception:
+            return
+        trim_dir(self.disk_dir, ".pt", self.disk_budget_mb * 1024 * 1024)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "resident_mb": round(self._bytes / (1024 * 1024), 1),
+                "budget_mb": self.budget_mb,
+                "disk_dir": self.disk_dir,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
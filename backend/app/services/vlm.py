@@ -1,36 +1,110 @@
-﻿import time, threading
-from typing import List, Tuple, Dict, Any, Iterable
+﻿import functools, gc, inspect, math, queue, threading, time
+from typing import List, Tuple, Dict, Any, Optional
 import torch
-from transformers import AutoProcessor, BitsAndBytesConfig, TextIteratorStreamer
+from transformers import AutoModelForCausalLM, AutoProcessor, BitsAndBytesConfig, DynamicCache, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+from PIL import Image
 try:
     from transformers import Qwen2VLForConditionalGeneration
 except Exception as e:
     raise RuntimeError("Transformers missing Qwen2VL classes. Update transformers >= 4.43.") from e
 
-from .images import resize_long_edge
+from ..config import settings
+from .context import compact_history
+from .cpu_engine import configure_cpu_runtime, cpu_load_dtype, optimize_for_cpu
+from .images import ImageSource, resize_long_edge
+from .metrics import DECODE_TOKENS_PER_S, TTFT_SECONDS, record, stage, tracing
+from .prefix_cache import PrefixCache
+from .vision_cache import VisionCache
+from .registry import ModelRegistry
+from .scheduler import ASSIST_MODES
 
-_MODEL_CACHE: Dict[Tuple[str,bool,bool,int], Tuple[Qwen2VLForConditionalGeneration, AutoProcessor]] = {}
+def _model_footprint(entry) -> int:
+    model, _ = entry
+    try:
+        return int(model.get_memory_footprint())
+    except Exception:
+        return 0
 
-def get_model(model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int):
-    key = (model_id, quant_4bit, use_cpu, max_image_edge)
-    if key in _MODEL_CACHE:
-        return _MODEL_CACHE[key]
+def _release_model(key, entry):
+    # Drop the registry's reference and hand the freed blocks back to the allocator.
+    del entry
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
+# Keyed only on what changes the weights; image size is a per-request preprocessing knob.
+_MODEL_REGISTRY = ModelRegistry(
+    budget_mb=settings.model_cache_budget_mb,
+    max_entries=settings.model_cache_max_models,
+    size_of=_model_footprint,
+    on_evict=_release_model,
+)
+
+# Per-session KV of the previous turn, so follow-up turns only prefill what is new
+_PREFIX_CACHE = PrefixCache(budget_mb=settings.prefix_cache_budget_mb, min_tokens=settings.prefix_cache_min_tokens)
+
+# Preprocessed pixels and vision-encoder outputs keyed by image content, shared across requests
+_VISION_CACHE = VisionCache(budget_mb=settings.vision_cache_budget_mb, disk_dir=settings.vision_cache_dir,
+                            disk_budget_mb=settings.vision_cache_disk_budget_mb)
+_VISION_KEYS = threading.local()
+
+# Draft models for assisted decoding live apart so they never push a main model out
+_ASSISTANT_REGISTRY = ModelRegistry(max_entries=1, size_of=lambda m: 0, on_evict=_release_model)
+_FORWARDS = threading.local()   # main-model forward calls during the current generate()
+
+def _load_model(model_id: str, quant_4bit: bool, use_cpu: bool):
     qconf = None
-    if quant_4bit:
+    # bitsandbytes 4-bit needs CUDA; on CPU the CPU engine quantizes after loading instead
+    if quant_4bit and not use_cpu:
         qconf = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type="nf4", bnb_4bit_compute_dtype=torch.float16)
+    if use_cpu:
+        configure_cpu_runtime()
 
-    dtype = torch.float32 if use_cpu else torch.float16
+    dtype = cpu_load_dtype() if use_cpu else torch.float16
     model = Qwen2VLForConditionalGeneration.from_pretrained(
         model_id,
         trust_remote_code=True,
-        device_map="auto",
+        device_map="cpu" if use_cpu else "auto",
         torch_dtype=dtype,
         quantization_config=qconf
     )
+    if use_cpu:
+        optimize_for_cpu(model)
     processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
-    _MODEL_CACHE[key] = (model, processor)
-    return _MODEL_CACHE[key]
+    # Batched prompts must be left-padded so every row continues from the same position
+    processor.tokenizer.padding_side = "left"
+    _install_vision_cache(model)
+    return model, processor
+
+def get_model(model_id: str, quant_4bit: bool, use_cpu: bool):
+    key = (model_id, quant_4bit, use_cpu)
+    return _MODEL_REGISTRY.get(key, lambda: _load_model(model_id, quant_4bit, use_cpu))
+
+def _load_assistant(model_id: str, use_cpu: bool):
+    dtype = cpu_load_dtype() if use_cpu else torch.float16
+    model = AutoModelForCausalLM.from_pretrained(model_id, device_map="cpu" if use_cpu else "auto", torch_dtype=dtype)
+    if use_cpu:
+        optimize_for_cpu(model)
+    _text_positions(model)
+    return model
+
+def _text_positions(model):
+    # generate() hands the draft the target's multimodal-RoPE position_ids ([sections, batch, seq]);
+    # for the text-only turns a draft serves every section is identical, so the first one is plain positions
+    def hook(module, args, kwargs):
+        pos = kwargs.get("position_ids")
+        if pos is not None and pos.dim() == 3:
+            kwargs["position_ids"] = pos[0]
+        return args, kwargs
+    model.register_forward_pre_hook(hook, with_kwargs=True)
+
+def get_assistant(model_id: str, use_cpu: bool):
+    return _ASSISTANT_REGISTRY.get((model_id, use_cpu), lambda: _load_assistant(model_id, use_cpu))
+
+def model_cache_stats() -> Dict[str, Any]:
+    return _MODEL_REGISTRY.stats()
 
 def build_msgs(history: List[Dict[str,str]], user_text: str, images: List) -> List[Dict[str, Any]]:
     msgs: List[Dict[str, Any]] = []
@@ -42,81 +116,517 @@ def build_msgs(history: List[Dict[str,str]], user_text: str, images: List) -> Li
     msgs.append({"role":"user","content":content})
     return msgs
 
-def chat_once(model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int, max_new_tokens: int,
-              history: List[Dict[str,str]], user_text: str, images: List):
-    from qwen_vl_utils import process_vision_info
-    model, processor = get_model(model_id, quant_4bit, use_cpu, max_image_edge)
-    images = [resize_long_edge(im, max_image_edge) for im in images]
-    msgs = build_msgs(history, user_text, images)
-
-    prompt = processor.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
-    vi, vv = process_vision_info(msgs)
-    inputs = processor(text=[prompt], images=vi, videos=vv, return_tensors="pt")
+def _pixel_key(model_id: str, src: ImageSource, max_image_edge: int, max_pixels: int = 0):
+    return ("pixels", model_id, src.digest, max_image_edge, max_pixels)
+
+def _pixels_per_image(processor, n_images: int, budget_tokens: int, max_image_edge: int) -> int:
+    """max_pixels for each of `n_images` so that together they stay within `budget_tokens` (0 = no cap).
+
+    One visual token covers a (patch * merge)^2 pixel square. A cap that max_image_edge already
+    satisfies is dropped so the cache keys match unbudgeted requests. The image sizes are not known
+    before decoding, so that test assumes the worst case, a square: a wide image that the cap would
+    not shrink still gets a capped key, i.e. the same pixels as a separate cache entry.
+    """
+    if budget_tokens <= 0 or n_images == 0:
+        return 0
+    ip = processor.image_processor
+    unit = (getattr(ip, "patch_size", 14) * getattr(ip, "merge_size", 2)) ** 2
+    max_pixels = max(settings.min_image_tokens, budget_tokens // n_images) * unit
+    return 0 if max_pixels >= max_image_edge ** 2 else max_pixels
+
+def _image_features(model_id: str, processor, src: ImageSource, max_image_edge: int, max_pixels: int = 0):
+    """Preprocessed pixels for one image: (cache key, tensors, cache hit), or None if it will not decode."""
+    key = _pixel_key(model_id, src, max_image_edge, max_pixels)
+    entry = _VISION_CACHE.get(key, persist=True)
+    if entry is not None:
+        return key, entry, True
+    try:
+        with stage("pdf_rasterize" if src.kind == "pdf_page" else "image_decode"):
+            im = src.load(max_image_edge)
+    except Exception:
+        return None   # undecodable uploads are skipped, as before
+    with stage("resize"):
+        im = resize_long_edge(im, max_image_edge)
+        if max_pixels:
+            w, h = im.size
+            if w * h > max_pixels:
+                scale = math.sqrt(max_pixels / (w * h))
+                im = im.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+    with stage("preprocess"):
+        if max_pixels:
+            # The pixel bounds go in `size`; min_pixels= / max_pixels= call kwargs are deprecated
+            floor = (processor.image_processor.size or {}).get("shortest_edge") or 56 * 56
+            out = processor.image_processor(images=[im], return_tensors="pt",
+                                            size={"shortest_edge": min(floor, max_pixels), "longest_edge": max_pixels})
+        else:
+            out = processor.image_processor(images=[im], return_tensors="pt")
+    entry = {"pixel_values": out["pixel_values"], "image_grid_thw": out["image_grid_thw"]}
+    _VISION_CACHE.put(key, entry, persist=True)
+    return key, entry, False
+
+@functools.lru_cache(maxsize=4)
+def _load_processor(model_id: str):
+    return AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+
+def preprocess_images(model_id: str, sources: List[ImageSource], max_image_edge: int,
+                      visual_token_budget: int = 0) -> int:
+    """Fills the vision cache for `sources` ahead of a request; returns how many were newly processed.
+
+    The entries match a request carrying exactly these images with the same visual_token_budget.
+    Needs only the processor, so it can run in the background without loading model weights.
+    """
+    processor = _load_processor(model_id)
+    max_pixels = _pixels_per_image(processor, len(sources), visual_token_budget, max_image_edge)
+    done = 0
+    for f in _iter_features(model_id, processor, sources, max_image_edge, max_pixels):
+        if f is not None and not f[2]:
+            done += 1
+    return done
+
+def _iter_features(model_id: str, processor, sources: List[ImageSource], max_image_edge: int, max_pixels: int = 0):
+    """_image_features for each source in order, starting uncached renders a few images ahead.
+
+    Images are decoded and PDF pages rasterized in the background while earlier ones are being
+    preprocessed, and each decoded image is dropped as soon as its tensors exist.
+    """
+    window = max(1, settings.pdf_render_workers, settings.image_decode_workers)
+    todo = [src for src in sources if _pixel_key(model_id, src, max_image_edge, max_pixels) not in _VISION_CACHE]
+    uncached = {id(src) for src in todo}
+    for src in todo[:window]:
+        src.prefetch(max_image_edge)
+    ahead = window
+    for src in sources:
+        if id(src) in uncached and ahead < len(todo):
+            todo[ahead].prefetch(max_image_edge)   # keep `window` renders in flight
+            ahead += 1
+        yield _image_features(model_id, processor, src, max_image_edge, max_pixels)
+
+def _expand_image_tokens(prompt: str, image_token: str, grids: List[torch.Tensor], merge_length: int) -> str:
+    # What the processor does when given images: one placeholder per merged patch
+    parts = prompt.split(image_token)
+    out = parts[0]
+    for grid, part in zip(grids, parts[1:]):
+        out += image_token * (int(grid.prod()) // merge_length) + part
+    return out
+
+def _prepare_inputs(model, processor, model_id: str, quant_4bit: bool, use_cpu: bool, rows: List[Dict[str, Any]]):
+    """Tokenizes one or more chat turns into a single left-padded batch.
+
+    Image pixels come from the vision cache when the same content was seen before at the same
+    edge and pixel cap; the row's visual_token_budget is shared evenly by its images, and its
+    oldest history turns are dropped past prompt_token_budget. Each row records its images'
+    encoder-cache keys, how many pixel lookups hit, its visual tokens and the dropped history.
+    """
+    tokenizer = processor.tokenizer
+    image_token = getattr(processor, "image_token", "<|image_pad|>")
+    merge_length = processor.image_processor.merge_size ** 2
+    traces = [row["trace"] for row in rows if row.get("trace") is not None]
+    prompts, pixels, grids = [], [], []
+    for row in rows:
+        row_trace = [row["trace"]] if row.get("trace") is not None else []
+        sources = [ImageSource.from_image(s) if isinstance(s, Image.Image) else s for s in row["images"]]
+        budget = row.get("visual_token_budget", settings.visual_token_budget)
+        max_pixels = _pixels_per_image(processor, len(sources), budget, row["max_image_edge"])
+        with tracing(row_trace):
+            feats = [f for f in _iter_features(model_id, processor, sources, row["max_image_edge"], max_pixels)
+                     if f is not None]
+        row["vision_keys"] = [("embeds", quant_4bit, use_cpu) + key[1:] for key, _, _ in feats]
+        row["image_cache_hits"] = sum(1 for _, _, hit in feats if hit)
+        row_grids = [entry["image_grid_thw"][0] for _, entry, _ in feats]
+        row["visual_tokens"] = sum(int(g.prod()) // merge_length for g in row_grids)
+
+        with stage("context", row_trace):
+            history, row["context"] = compact_history(tokenizer, row["history"], row["user_text"],
+                                                      row["visual_tokens"], settings.prompt_token_budget)
+        msgs = build_msgs(history, row["user_text"], [key for key, _, _ in feats])
+        with stage("chat_template", row_trace):
+            prompt = processor.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
+        prompts.append(_expand_image_tokens(prompt, image_token, row_grids, merge_length))
+        pixels.extend(entry["pixel_values"] for _, entry, _ in feats)
+        grids.extend(row_grids)
+
+    with stage("tokenize", traces):
+        inputs = dict(tokenizer(prompts, padding=True, return_tensors="pt"))
+    if pixels:
+        inputs["pixel_values"] = torch.cat(pixels)
+        inputs["image_grid_thw"] = torch.stack(grids)
+    if "mm_token_type_ids" in getattr(processor, "model_input_names", []):
+        image_token_id = tokenizer.convert_tokens_to_ids(image_token)
+        inputs["mm_token_type_ids"] = (inputs["input_ids"] == image_token_id).long()
     if model.device.type == "cuda":
-        inputs = {k: v.to(model.device, non_blocking=True) for k, v in inputs.items()}
+        with stage("h2d_copy", traces):
+            inputs = {k: v.to(model.device, non_blocking=True) for k, v in inputs.items()}
+    return inputs
 
-    t0 = time.time()
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs, max_new_tokens=max_new_tokens, do_sample=False, temperature=0.0,
-            top_p=1.0, return_dict_in_generate=True
-        )
-    latency_ms = int((time.time() - t0) * 1000)
+def _install_vision_cache(model):
+    """Wraps the vision tower so images whose encoder output is cached skip the encoder.
+
+    The keys of the images in the current generate() call are passed via _VISION_KEYS; a call
+    without keys (or with a mismatched image count) goes straight to the original forward.
+    """
+    visual = getattr(model, "visual", None) or getattr(getattr(model, "model", None), "visual", None)
+    if visual is None or getattr(visual, "_valormm_cached", False):
+        return
+    original = visual.forward
+    merge = getattr(visual, "spatial_merge_size", 2)
+    state = {"tensor_output": None}
+
+    def forward(hidden_states, grid_thw=None, **kwargs):
+        keys = getattr(_VISION_KEYS, "keys", None)
+        if not keys or grid_thw is None or len(keys) != grid_thw.shape[0]:
+            return original(hidden_states, grid_thw=grid_thw, **kwargs)
+        cached = [_VISION_CACHE.get(k) for k in keys]
+        if all(c is not None for c in cached) and state["tensor_output"] is None:
+            cached = [None] * len(keys)   # output type unknown until the encoder has run once
+        _VISION_KEYS.hits = [c is not None for c in cached]
+
+        patches = grid_thw.prod(-1).tolist()
+        pieces: List[Optional[torch.Tensor]] = [None] * len(keys)
+        missing = [i for i, c in enumerate(cached) if c is None]
+        if missing:
+            chunks = hidden_states.split(patches)
+            out = original(torch.cat([chunks[i] for i in missing]), grid_thw=grid_thw[missing], **kwargs)
+            state["tensor_output"] = isinstance(out, torch.Tensor)
+            embeds = out if state["tensor_output"] else out.pooler_output
+            for i, e in zip(missing, embeds.split([patches[i] // merge ** 2 for i in missing])):
+                pieces[i] = e
+                _VISION_CACHE.put(keys[i], {"embeds": e})
+        for i, c in enumerate(cached):
+            if c is not None:
+                pieces[i] = c["embeds"].to(hidden_states.device)
+        merged = torch.cat(pieces)
+        if state["tensor_output"]:
+            return merged
+        return BaseModelOutputWithPooling(pooler_output=merged)
+
+    visual.forward = forward
+    visual._valormm_cached = True
+
+class _RowTokenLimit(StoppingCriteria):
+    """Finishes each batch row at its own max_new_tokens (generate runs to the largest one)."""
+    def __init__(self, prompt_len: int, limits: List[int]):
+        self.prompt_len = prompt_len
+        self.limits = torch.tensor(limits)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        produced = input_ids.shape[1] - self.prompt_len
+        return produced >= self.limits.to(input_ids.device)
+
+class _RowCancel(StoppingCriteria):
+    """Finishes rows whose request was cancelled, so a dropped client stops costing GPU time.
 
+    A row's `cancelled` callable returns the reason ("" = keep going). Its limit is cut to what
+    was produced so far, which also stops the streamer and trims the returned answer.
+    """
+    def __init__(self, prompt_len: int, rows: List[Dict[str, Any]], limits: List[int]):
+        self.prompt_len = prompt_len
+        self.rows = rows
+        self.limits = limits
+
+    def __call__(self, input_ids, scores, **kwargs):
+        produced = input_ids.shape[1] - self.prompt_len
+        done = []
+        for i, row in enumerate(self.rows):
+            if not row.get("cancel_reason") and row.get("cancelled") is not None:
+                reason = row["cancelled"]()
+                if reason:
+                    row["cancel_reason"] = reason
+                    self.limits[i] = min(self.limits[i], produced)
+            done.append(bool(row.get("cancel_reason")))
+        return torch.tensor(done, device=input_ids.device)
+
+class BatchStreamer(BaseStreamer):
+    """Splits generate()'s per-step token batch back into one text stream per row.
+
+    Each row with an `out` queue receives only newly generated text, decoded incrementally so
+    multi-byte characters and leading spaces come through intact.
+    """
+    def __init__(self, tokenizer, outs: List[Optional["queue.Queue"]], limits: List[int], stop_ids: List[int]):
+        self.tokenizer = tokenizer
+        self.outs = outs
+        self.limits = limits
+        self.stop_ids = set(stop_ids)
+        self.tokens: List[List[int]] = [[] for _ in outs]
+        self.printed = [0] * len(outs)
+        self.finished = [False] * len(outs)
+        self.prompt_seen = False
+        self.first_token_at: Optional[float] = None
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True   # first call carries the prompt
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.time()   # end of prefill
+        if value.dim() == 1:
+            value = value[:, None]
+        for i, row in enumerate(value.tolist()):
+            for tok in row:
+                if self.finished[i]:
+                    break
+                if tok in self.stop_ids:
+                    self.finished[i] = True
+                    break
+                self.tokens[i].append(tok)
+                if len(self.tokens[i]) >= self.limits[i]:
+                    self.finished[i] = True
+            self._flush(i, final=False)
+
+    def end(self):
+        for i in range(len(self.outs)):
+            self._flush(i, final=True)
+
+    def _flush(self, i: int, final: bool):
+        if self.outs[i] is None:
+            return
+        text = self.tokenizer.decode(self.tokens[i], skip_special_tokens=True)
+        # Hold back a trailing partial UTF-8 sequence until the next token completes it
+        if not final and text.endswith("\ufffd"):
+            return
+        chunk = text[self.printed[i]:]
+        if chunk:
+            self.printed[i] = len(text)
+            self.outs[i].put(chunk)
+
+def _stop_token_ids(model, tokenizer) -> List[int]:
+    ids = model.generation_config.eos_token_id
+    ids = list(ids) if isinstance(ids, (list, tuple)) else ([ids] if ids is not None else [])
+    if tokenizer.pad_token_id is not None:
+        ids.append(tokenizer.pad_token_id)
+    return ids
+
+def _cache_layers(cache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    if hasattr(cache, "layers"):   # transformers >= 4.56
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]   # legacy tuple-of-tuples
+
+def _slice_cache(cache, row: int, start: int, end: int, clone: bool = False):
+    """New DynamicCache holding positions [start, end) of one batch row."""
+    out = DynamicCache()
+    for idx, (k, v) in enumerate(_cache_layers(cache)):
+        k, v = k[row:row + 1, :, start:end], v[row:row + 1, :, start:end]
+        if clone:
+            k, v = k.clone(), v.clone()
+        out.update(k, v, idx)
+    return out
+
+def _cache_nbytes(cache) -> int:
+    return sum(k.nelement() * k.element_size() + v.nelement() * v.element_size() for k, v in _cache_layers(cache))
+
+def _reset_rope_deltas(model, batch_size: int):
+    # Prefix-cached turns are text-only, so M-RoPE positions are plain offsets (delta 0). Clear any
+    # delta left on the model by an earlier image request before continuing from the cache.
+    zeros = torch.zeros(batch_size, 1, dtype=torch.long, device=model.device)
+    for owner in (model, getattr(model, "model", None)):
+        if owner is not None and hasattr(owner, "rope_deltas"):
+            owner.rope_deltas = zeros
+    return zeros
+
+def _assist_mode(row: Dict[str, Any]) -> str:
+    """Assisted decoding for a row: "", "prompt_lookup" or "draft".
+
+    Only text turns (PDF text layers included) are assisted: prompt lookup would copy image
+    placeholder tokens out of the prompt as candidates, and a text draft model cannot take the
+    pixel inputs generate() forwards to it. Without an assistant_model_id, "draft" falls back
+    to prompt lookup.
+    """
+    mode = row.get("assist", settings.assist_mode) or ""
+    if mode not in ASSIST_MODES:
+        raise ValueError(f"Unknown assist mode: {mode!r}")
+    if mode == "none" or row["images"]:
+        return ""
+    if mode == "draft" and not settings.assistant_model_id:
+        return "prompt_lookup"
+    return mode
+
+def _count_forwards(model):
+    # Each main-model forward in assisted decoding verifies one batch of draft tokens
+    if getattr(model, "_valormm_counted", False):
+        return
+    def hook(module, args, kwargs):
+        if getattr(_FORWARDS, "count", None) is not None:
+            _FORWARDS.count += 1
+    model.register_forward_pre_hook(hook, with_kwargs=True)
+    model._valormm_counted = True
+
+def _generate(model, processor, tokenizer, rows: List[Dict[str, Any]], inputs,
+              prefix=None, prefix_len: int = 0, assist: str = "", use_cpu: bool = False) -> List[Tuple[str, Dict[str, Any]]]:
     prompt_len = int(inputs["input_ids"].shape[1])
-    generated = outputs.sequences[:, prompt_len:]
-    text = processor.batch_decode(generated, skip_special_tokens=True)[0].strip()
+    limits = [int(r["max_new_tokens"]) for r in rows]
+    stop_ids = _stop_token_ids(model, tokenizer)
 
-    prompt_tokens = prompt_len
-    completion_tokens = int(generated.shape[1])
-    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "latency_ms": latency_ms}
-    return text, usage
+    gen_kwargs = dict(
+        max_new_tokens=max(limits), do_sample=False, temperature=0.0, top_p=1.0, return_dict_in_generate=True,
+        stopping_criteria=StoppingCriteriaList([_RowTokenLimit(prompt_len, limits), _RowCancel(prompt_len, rows, limits)]),
+    )
+    # Always attached: besides streaming it timestamps the first token (rows without `out` are not decoded)
+    streamer = BatchStreamer(tokenizer, [r.get("out") for r in rows], limits, stop_ids)
+    gen_kwargs["streamer"] = streamer
+    if prefix is not None:
+        gen_kwargs["past_key_values"] = prefix
+        deltas = _reset_rope_deltas(model, len(rows))
+        if "rope_deltas" in inspect.signature(model.forward).parameters:
+            gen_kwargs["rope_deltas"] = deltas
 
-def stream_chat_once(model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int, max_new_tokens: int,
-                     history: List[Dict[str,str]], user_text: str, images: List) -> Iterable[str]:
-    """Streaming generator yielding only assistant text (no role preamble), spaces preserved."""
-    from qwen_vl_utils import process_vision_info
+    if assist == "prompt_lookup":
+        gen_kwargs["prompt_lookup_num_tokens"] = settings.prompt_lookup_tokens
+    elif assist == "draft":
+        assistant = get_assistant(settings.assistant_model_id, use_cpu)
+        assistant.generation_config.num_assistant_tokens = settings.assistant_tokens
+        gen_kwargs["assistant_model"] = assistant
+        inputs = {k: v for k, v in inputs.items() if k in ("input_ids", "attention_mask")}
+    if assist:
+        _count_forwards(model)
+
+    _VISION_KEYS.keys = [k for r in rows for k in r.get("vision_keys", [])]
+    _VISION_KEYS.hits = []
+    _FORWARDS.count = 0
+    t0 = time.time()
+    try:
+        with torch.no_grad():
+            outputs = model.generate(**inputs, **gen_kwargs)
+    finally:
+        _VISION_KEYS.keys = None
+        forwards, _FORWARDS.count = _FORWARDS.count, None
+    t1 = time.time()
+    latency_ms = int((t1 - t0) * 1000)
+    first = streamer.first_token_at or t1
+    traces = [r["trace"] for r in rows if r.get("trace") is not None]
+    record("prefill", first - t0, traces)
+    record("decode", t1 - first, traces)
+    TTFT_SECONDS.observe(first - t0)
+    embed_hits = list(_VISION_KEYS.hits)
 
-    model, processor = get_model(model_id, quant_4bit, use_cpu, max_image_edge)
-    images = [resize_long_edge(im, max_image_edge) for im in images]
-    msgs = build_msgs(history, user_text, images)
+    cache = getattr(outputs, "past_key_values", None)
+    cache_len = cache.get_seq_length() if cache is not None and hasattr(cache, "get_seq_length") else 0
+    prompt_ids = inputs["input_ids"].tolist()
+    generated = outputs.sequences[:, prompt_len:].tolist()
+    results = []
+    for i, row in enumerate(rows):
+        toks = generated[i][:limits[i]]
+        n = next((j + 1 for j, t in enumerate(toks) if t in stop_ids), len(toks))
+        text = tokenizer.decode(toks[:n], skip_special_tokens=True).strip()
+        real_len = int(inputs["attention_mask"][i].sum())
+        tokens_per_s = round((n - 1) / (t1 - first), 1) if n > 1 and t1 > first else 0.0
+        if tokens_per_s:
+            DECODE_TOKENS_PER_S.observe(tokens_per_s)
+        usage = {
+            "prompt_tokens": real_len,
+            "completion_tokens": n,
+            "latency_ms": latency_ms,
+            "ttft_ms": int((first - t0) * 1000),
+            "decode_tokens_per_s": tokens_per_s,
+            "assist_mode": assist,
+            "batch_size": len(rows),
+            "prefix_cache_hit": prefix is not None,
+            "cached_prompt_tokens": prefix_len,
+            "image_cache_hits": row.get("image_cache_hits", 0),
+            "vision_embed_hits": sum(embed_hits[:len(row.get("vision_keys", []))]),
+            "visual_tokens": row.get("visual_tokens", 0),
+            "cancelled": bool(row.get("cancel_reason")),
+            "cancel_reason": row.get("cancel_reason", ""),
+        }
+        if assist and forwards:
+            # Every verify step yields one token of its own; anything beyond came from the draft
+            accepted = max(0, n - forwards)
+            usage["accepted_draft_tokens"] = accepted
+            usage["draft_acceptance_rate"] = round(accepted / n, 3) if n else 0.0
+        usage.update(row.get("ingest", {}))   # how the row's documents were turned into text / images
+        usage.update(row.get("context", {}))  # history turns dropped to fit prompt_token_budget
+        embed_hits = embed_hits[len(row.get("vision_keys", [])):]
+        results.append((text, usage))
 
-    prompt = processor.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
-    vi, vv = process_vision_info(msgs)
-    inputs = processor(text=[prompt], images=vi, videos=vv, return_tensors="pt")
-    if model.device.type == "cuda":
-        inputs = {k: v.to(model.device, non_blocking=True) for k, v in inputs.items()}
+        # Keep what this session's KV now holds: prompt without left padding plus the fed answer tokens
+        session = row.get("session_key")
+        if session is not None and cache_len:
+            pad = prompt_len - real_len
+            tokens = (prompt_ids[i][pad:] + toks[:n])[:cache_len - pad]
+            kv = _slice_cache(cache, i, pad, pad + len(tokens), clone=len(rows) > 1)
+            _PREFIX_CACHE.put(session, tokens, kv, _cache_nbytes(kv))
+    return results
 
+def chat_batch(model_id: str, quant_4bit: bool, use_cpu: bool, rows: List[Dict[str, Any]]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Runs several chat turns for the same model through one generate() call.
+
+    Each row is a dict with max_image_edge, max_new_tokens, history, user_text, images and the
+    optional `out` (queue for streamed text), `session_id`, `cancelled` (see _RowCancel) and
+    `assist` (see _assist_mode). Text-only turns of a session whose earlier turn is still in the
+    prefix cache run on their own and only prefill the new suffix; assisted turns also run alone,
+    since assisted generation is limited to batch size 1. Returns (answer, usage) per row, in order;
+    a row whose inputs cannot be built gets its exception instead, and the other rows still run.
+    """
+    model, processor = get_model(model_id, quant_4bit, use_cpu)
     tokenizer = getattr(processor, "tokenizer", None)
     if tokenizer is None:
         raise RuntimeError("Processor has no tokenizer; update transformers/qwen-vl-utils.")
 
-    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True, decode_kwargs={"skip_special_tokens": True})
-    gen_kwargs = dict(
-        **inputs, max_new_tokens=max_new_tokens, do_sample=False, temperature=0.0, top_p=1.0, streamer=streamer
-    )
+    results: List[Any] = [None] * len(rows)
+    batched = []
+    for i, row in enumerate(rows):
+        row["session_key"] = (row["session_id"], model_id, quant_4bit, use_cpu) if row.get("session_id") else None
+        try:
+            assist = _assist_mode(row)
+            inputs = None
+            # Assisted generation does not continue a reused KV prefix correctly, so assisted turns prefill in full
+            if row["session_key"] is not None and not row["images"] and not assist:
+                inputs = _prepare_inputs(model, processor, model_id, quant_4bit, use_cpu, [row])
+                prefix, matched = _PREFIX_CACHE.take(row["session_key"], inputs["input_ids"][0].tolist())
+                if prefix is not None:
+                    prefix = _slice_cache(prefix, 0, 0, matched)
+                    results[i] = _generate(model, processor, tokenizer, [row], inputs, prefix, matched)[0]
+                    continue
+            if assist:
+                if inputs is None:
+                    inputs = _prepare_inputs(model, processor, model_id, quant_4bit, use_cpu, [row])
+                results[i] = _generate(model, processor, tokenizer, [row], inputs, assist=assist, use_cpu=use_cpu)[0]
+                continue
+        except Exception as e:
+            results[i] = e
+            continue
+        batched.append(i)
 
-    thread = threading.Thread(target=model.generate, kwargs=gen_kwargs)
-    thread.start()
+    if batched:
+        try:
+            inputs = _prepare_inputs(model, processor, model_id, quant_4bit, use_cpu, [rows[i] for i in batched])
+        except Exception:
+            # Some row cannot be tokenized: find it by preparing each alone, then batch the rest
+            good = []
+            for i in batched:
+                try:
+                    _prepare_inputs(model, processor, model_id, quant_4bit, use_cpu, [rows[i]])
+                    good.append(i)
+                except Exception as e:
+                    results[i] = e
+            batched = good
+            inputs = _prepare_inputs(model, processor, model_id, quant_4bit, use_cpu, [rows[i] for i in batched]) \
+                if batched else None
+        if batched:
+            for i, result in zip(batched, _generate(model, processor, tokenizer, [rows[i] for i in batched], inputs)):
+                results[i] = result
+    return results
 
-    prebuf = ""
-    cleaned = False
-    marker = "assistant\n"  # Qwen chat template marker
+def _one(result):
+    if isinstance(result, BaseException):
+        raise result
+    return result
 
-    for chunk in streamer:
-        if not chunk:
-            continue
-        if not cleaned:
-            prebuf += chunk
-            # strip everything up to and including last 'assistant\n'
-            idx = prebuf.rfind(marker)
-            if idx != -1:
-                cleaned = True
-                rest = prebuf[idx + len(marker):]
-                if rest:
-                    yield rest
-                prebuf = ""
-            # else keep buffering until marker appears
-        else:
-            # pass through untouched (do not trim)
-            yield chunk
+def prefix_cache_stats() -> Dict[str, Any]:
+    return _PREFIX_CACHE.stats()
+
+def vision_cache_stats() -> Dict[str, Any]:
+    return _VISION_CACHE.stats()
+
+def chat_once(model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int, max_new_tokens: int,
+              history: List[Dict[str,str]], user_text: str, images: List):
+    row = {"max_image_edge": max_image_edge, "max_new_tokens": max_new_tokens,
+           "history": history, "user_text": user_text, "images": images}
+    return _one(chat_batch(model_id, quant_4bit, use_cpu, [row])[0])
+
+def stream_chat_once(model_id: str, quant_4bit: bool, use_cpu: bool, max_image_edge: int, max_new_tokens: int,
+                     history: List[Dict[str,str]], user_text: str, images: List, out: "queue.Queue") -> Dict[str, int]:
+    """Runs generation on the calling thread, pushing assistant text chunks (no role preamble) into `out`."""
+    row = {"max_image_edge": max_image_edge, "max_new_tokens": max_new_tokens,
+           "history": history, "user_text": user_text, "images": images, "out": out}
+    return _one(chat_batch(model_id, quant_4bit, use_cpu, [row])[0])[1]
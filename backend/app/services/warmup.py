@@ -0,0 +1,82 @@
+﻿from typing import Any, Dict, List, Optional, Tuple
+import threading, time
+import torch
+from PIL import Image
+
+from ..config import settings
+from .executor import inference_executor
+from .images import ImageSource
+from .vlm import chat_batch, get_model
+
+
+class StartupState:
+    """Progress of the startup preload / warm-up, reported by /ready.
+
+    `phases` holds one entry per finished phase with its duration, e.g.
+    {"phase": "load", "model": "...", "ms": 8123}.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.error = ""
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.phases: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add_phase(self, phase: str, t0: float, **extra):
+        with self._lock:
+            self.phases.append(dict(phase=phase, ms=int((time.time() - t0) * 1000), **extra))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = None
+            if self.started_at is not None:
+                total = int(((self.finished_at or time.time()) - self.started_at) * 1000)
+            return {"ready": self.ready, "error": self.error, "startup_ms": total, "phases": list(self.phases)}
+
+
+def _targets() -> List[Tuple[str, bool, bool]]:
+    ids = settings.preload_models or [settings.model_id]
+    return [(model_id, settings.quant_4bit, settings.use_cpu) for model_id in ids]
+
+def _warm_up(state: StartupState):
+    # Runs on an inference worker, so it never overlaps a real generate() beyond the worker limit
+    state.started_at = time.time()
+    try:
+        if torch.cuda.is_available():
+            t0 = time.time()
+            torch.cuda.init()
+            torch.zeros(1, device="cuda")   # creates the context
+            state.add_phase("cuda_init", t0)
+        for model_id, quant_4bit, use_cpu in _targets():
+            t0 = time.time()
+            get_model(model_id, quant_4bit, use_cpu)
+            state.add_phase("load", t0, model=model_id)
+            if not settings.warmup_generate:
+                continue
+            # A dummy image exercises the vision tower, the processor and a short decode
+            t0 = time.time()
+            image = ImageSource.from_image(Image.effect_noise((448, 448), 64).convert("RGB"))
+            row = {"max_image_edge": settings.max_image_edge, "max_new_tokens": settings.warmup_new_tokens,
+                   "history": [], "user_text": "Describe the image.", "images": [image]}
+            result = chat_batch(model_id, quant_4bit, use_cpu, [row])[0]
+            if isinstance(result, BaseException):
+                raise result
+            _, usage = result
+            state.add_phase("warmup", t0, model=model_id, ttft_ms=usage.get("ttft_ms", 0))
+        state.ready = True
+    except Exception as e:
+        state.error = f"{type(e).__name__}: {e}"
+    finally:
+        state.finished_at = time.time()
+
+def start_warm_up(state: StartupState):
+    """Preloads and warms the configured models in the background; /ready flips once done."""
+    if not settings.preload_on_startup:
+        state.ready = True
+        return
+    inference_executor.submit(_warm_up, state)
+
+
+startup_state = StartupState()
@@ -0,0 +1,379 @@
+﻿from collections import OrderedDict
+from concurrent.futures import Future, wait
+from typing import Any, Dict, List, Optional
+import logging, multiprocessing, os, queue, threading, time, uuid
+
+from ..config import settings
+from .executor import AdmissionError, InferenceJob
+from .metrics import Trace
+from .scheduler import _STREAM_END, DuplicateRequestId, validate_chat
+
+log = logging.getLogger(__name__)
+
+
+class WorkerUnavailable(AdmissionError):
+    status_code = 503
+
+
+# ---------------------------------------------------------------- worker process
+
+def _configure_worker(device: str, models: List[str]):
+    # Runs before the model stack is imported, so CUDA and the CPU engine only see this assignment
+    settings.model_workers = 0
+    kind, _, index = device.partition(":")
+    if kind == "cuda" and index:
+        os.environ["CUDA_VISIBLE_DEVICES"] = index
+    elif kind == "cpu":
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+        settings.use_cpu = True
+        if index:
+            settings.cpu_numa_node = int(index)
+    if models:
+        settings.preload_models = models
+
+def _worker_main(index: int, device: str, models: List[str], conn):
+    """Entry point of a model worker: serves chat jobs arriving on `conn` with the in-process stack."""
+    _configure_worker(device, models)
+    from .inference import cancel_chat, local_stats, register_collectors, submit_chat
+    from .metrics import render as render_metrics
+    from .vlm import model_cache_stats
+    from .warmup import start_warm_up, startup_state
+    register_collectors()
+
+    send_lock = threading.Lock()
+    def send(*msg):
+        with send_lock:
+            try:
+                conn.send(msg)
+            except Exception:
+                # e.g. an exception type that does not pickle; the front only needs its text
+                if msg[0] == "error":
+                    conn.send(("error", msg[1], RuntimeError(str(msg[2]))))
+
+    def finished(job_id: str, req):
+        exc = req.future.exception()
+        send("error", job_id, exc) if exc is not None else send("done", job_id, *req.future.result())
+
+    def pump(job_id: str, req):
+        # Chunks first, the result last, so the front can close the stream on "done"
+        while True:
+            try:
+                item = req.out.get(timeout=0.5)
+            except queue.Empty:
+                # Failed before it ever ran (cancel, queue timeout): there will be no end marker
+                if req.future.done() and req.out.empty():
+                    break
+                continue
+            if item is _STREAM_END:
+                break
+            send("chunk", job_id, item)
+        req.future.exception()   # waits for the result
+        finished(job_id, req)
+
+    def started(job_id: str, f):
+        if f.exception() is None:
+            send("started", job_id, f.result())
+
+    def start(job_id: str, kwargs: Dict[str, Any]):
+        if device.startswith("cpu"):
+            kwargs["use_cpu"] = True
+        try:
+            req = submit_chat(request_id=job_id, **kwargs)
+        except BaseException as e:
+            send("error", job_id, e)
+            return
+        req.started.add_done_callback(lambda f: started(job_id, f))
+        if req.out is not None:
+            threading.Thread(target=pump, args=(job_id, req), daemon=True).start()
+        else:
+            req.future.add_done_callback(lambda f: finished(job_id, req))
+
+    start_warm_up(startup_state)
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg[0] == "chat":
+            start(msg[1], msg[2])
+        elif msg[0] == "cancel":
+            cancel_chat(msg[1], msg[2])
+        elif msg[0] == "ping":
+            state = startup_state.snapshot()
+            loaded = [entry[0] for entry in model_cache_stats()["entries"]]
+            send("pong", {"ready": state["ready"], "error": state["error"], "models": loaded})
+        elif msg[0] == "stats":
+            send("stats", msg[1], {"stats": local_stats(), "metrics": render_metrics()})
+        elif msg[0] == "stop":
+            break
+    os._exit(0)
+
+
+# ---------------------------------------------------------------- front process
+
+class RemoteChat(InferenceJob):
+    """A chat turn running on a model worker; same surface as ChatRequest for the API layer."""
+
+    def __init__(self, request_id: str, stream: bool, trace: Optional[Trace]):
+        super().__init__()
+        self.request_id = request_id
+        self.out = queue.Queue() if stream else None
+        self.trace = trace or Trace()
+        self.worker: Optional["WorkerHandle"] = None
+
+
+class WorkerHandle:
+    def __init__(self, index: int, device: str, models: List[str]):
+        self.index = index
+        self.device = device
+        self.assigned = list(models)
+        self.models = set(models)   # assigned, loaded or already routed here
+        self.process = None
+        self.conn = None
+        self.jobs: Dict[str, RemoteChat] = {}
+        self.pending: Dict[str, Future] = {}   # stats requests by token
+        self.ready = False
+        self.error = ""
+        self.last_seen = 0.0
+        self.started_at = 0.0
+        self.restarts = 0
+        self.served = 0
+        self._send_lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def send(self, *msg):
+        with self._send_lock:
+            self.conn.send(msg)
+
+
+class WorkerPool:
+    """Model-serving worker processes behind the API process.
+
+    Each worker owns one device assignment (`cuda:N`, `cpu`, `cpu:<numa node>` or "" for the
+    default) and runs the usual executor / batch scheduler / caches for the models it serves.
+    The API process only parses requests and routes them over a pipe: a session stays on the
+    worker holding its KV prefix, otherwise the least loaded worker wins, counting a worker that
+    has not loaded the model yet as `batch_max_size` requests busier. Workers answer pings; one
+    that died or stopped answering for `worker_health_timeout_s` is restarted and its requests
+    fail with 503.
+    """
+
+    def __init__(self, workers: int, devices: List[str], models: List[str]):
+        self.enabled = workers > 0
+        self._workers = [WorkerHandle(i, devices[i % len(devices)] if devices else "",
+                                      [models[i % len(models)]] if models else [])
+                         for i in range(workers)]
+        self._sessions: "OrderedDict[str, WorkerHandle]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._ctx = multiprocessing.get_context("spawn")
+
+    def start(self):
+        for w in self._workers:
+            self._spawn(w)
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        for w in self._workers:
+            try:
+                w.send("stop")
+            except Exception:
+                pass
+        for w in self._workers:
+            if w.process is not None:
+                w.process.join(timeout=5)
+                if w.process.is_alive():
+                    w.process.kill()
+
+    def _spawn(self, w: WorkerHandle):
+        parent, child = self._ctx.Pipe()
+        # Not a daemon: workers start their own PDF render processes
+        w.process = self._ctx.Process(target=_worker_main, args=(w.index, w.device, w.assigned, child),
+                                      name=f"valormm-worker-{w.index}")
+        w.process.start()
+        child.close()
+        w.conn, w.ready, w.error = parent, False, ""
+        w.started_at, w.last_seen = time.time(), 0.0
+        threading.Thread(target=self._read, args=(w, parent), name=f"worker-{w.index}-reader", daemon=True).start()
+
+    def _read(self, w: WorkerHandle, conn):
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            w.last_seen = time.time()
+            if msg[0] == "pong":
+                w.ready, w.error = msg[1]["ready"], msg[1]["error"]
+                w.models.update(msg[1]["models"])
+                continue
+            if msg[0] == "stats":
+                f = w.pending.pop(msg[1], None)
+                if f is not None:
+                    f.set_result(msg[2])
+                continue
+            job = w.jobs.get(msg[1])
+            if job is None:
+                continue
+            if msg[0] == "started":
+                job.started_at = time.time()
+                job.started.set_result(msg[2])
+            elif msg[0] == "chunk":
+                job.out.put(msg[2])
+            else:
+                self._complete(w, job, result=msg[2:] if msg[0] == "done" else None,
+                               error=msg[2] if msg[0] == "error" else None)
+        if conn is w.conn:
+            self._fail_all(w, f"model worker {w.index} exited")
+
+    def _complete(self, w: WorkerHandle, job: RemoteChat, result=None, error: BaseException = None):
+        with self._lock:
+            # The reader (worker EOF) and the monitor (restart) can both fail the same jobs
+            if w.jobs.pop(job.request_id, None) is None:
+                return
+            w.served += 1
+        if error is None:
+            answer, usage = result
+            # The worker's stages join the ones recorded here (multipart read, ...)
+            for name, ms in usage.get("stages_ms", {}).items():
+                job.trace.add(name, ms)
+            usage["stages_ms"] = job.trace.as_dict()
+        if not job.started.done():
+            job.started.set_exception(error) if error is not None else job.started.set_result(0)
+        if job.out is not None:
+            job.out.put(_STREAM_END)
+        job.future.set_exception(error) if error is not None else job.future.set_result((answer, usage))
+
+    def _fail_all(self, w: WorkerHandle, reason: str):
+        with self._lock:
+            jobs = list(w.jobs.values())
+        for job in jobs:
+            self._complete(w, job, error=WorkerUnavailable(f"{reason}; retry the request"))
+
+    def _monitor(self):
+        while not self._stopped.wait(settings.worker_health_interval_s):
+            for w in self._workers:
+                if self._stopped.is_set():
+                    return
+                try:
+                    self._check(w)
+                except Exception:
+                    # One bad check must not end health monitoring for every worker
+                    log.exception("health check of model worker %d failed", w.index)
+
+    def _check(self, w: WorkerHandle):
+        # A worker still importing its stack is only checked for being alive
+        silent = w.last_seen and time.time() - w.last_seen > settings.worker_health_timeout_s
+        if w.alive and not silent:
+            try:
+                w.send("ping")
+                return
+            except Exception:
+                pass
+        if w.alive:
+            w.process.kill()
+            w.process.join(timeout=5)
+        conn, w.conn = w.conn, None
+        self._fail_all(w, f"model worker {w.index} was restarted")
+        if conn is not None:
+            conn.close()
+        w.restarts += 1
+        self._spawn(w)
+
+    def _route(self, model_id: str, session_id: str) -> WorkerHandle:
+        with self._lock:
+            alive = [w for w in self._workers if w.alive and w.conn is not None]
+            if not alive:
+                raise WorkerUnavailable("No model worker is running; retry shortly")
+            w = self._sessions.get(session_id) if session_id else None
+            if w is None or w not in alive:
+                w = min(alive, key=lambda h: (len(h.jobs) + (0 if model_id in h.models else settings.batch_max_size),
+                                              h.index))
+            if session_id:
+                self._sessions[session_id] = w
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > 4096:
+                    self._sessions.popitem(last=False)
+            w.models.add(model_id)
+            return w
+
+    def submit_chat(self, request_id: str = "", trace: Trace = None, stream: bool = False,
+                    **kwargs) -> RemoteChat:
+        """Routes a chat turn to a worker; takes the same arguments as inference.submit_chat."""
+        validate_chat(kwargs["history"], kwargs["max_image_edge"], kwargs["max_new_tokens"],
+                      kwargs.get("pdf_pages", ""), kwargs.get("pdf_mode", ""), kwargs.get("assist", ""))
+        job = RemoteChat(request_id or uuid.uuid4().hex, stream, trace)
+        w = self._route(kwargs["model_id"], kwargs.get("session_id", ""))
+        with self._lock:
+            if any(job.request_id in h.jobs for h in self._workers):
+                raise DuplicateRequestId(f"request_id {job.request_id} is already in use")
+            w.jobs[job.request_id] = job
+        job.worker = w
+        try:
+            w.send("chat", job.request_id, dict(kwargs, stream=stream))
+        except Exception as e:
+            with self._lock:
+                w.jobs.pop(job.request_id, None)
+            raise WorkerUnavailable(f"model worker {w.index} is unavailable: {e}") from e
+        return job
+
+    def cancel_chat(self, request_id: str, reason: str = "client") -> bool:
+        with self._lock:
+            w = next((h for h in self._workers if request_id in h.jobs), None)
+        if w is None:
+            return False
+        try:
+            w.send("cancel", request_id, reason)
+        except Exception:
+            return False
+        return True
+
+    def collect(self, timeout: float = 2.0) -> List[Dict[str, Any]]:
+        """Stats and rendered metrics of every live worker: [{"index", "stats", "metrics"}].
+
+        A worker that does not answer within `timeout` is left out.
+        """
+        asked = []
+        for w in self._workers:
+            if not w.alive or w.conn is None:
+                continue
+            token, f = uuid.uuid4().hex, Future()
+            w.pending[token] = f
+            try:
+                w.send("stats", token)
+            except Exception:
+                w.pending.pop(token, None)
+                continue
+            asked.append((w, token, f))
+        wait([f for _, _, f in asked], timeout=timeout)
+        out = []
+        for w, token, f in asked:
+            w.pending.pop(token, None)
+            if f.done():
+                out.append({"index": w.index, **f.result()})
+        return out
+
+    def ready(self) -> bool:
+        return all(w.ready for w in self._workers)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "alive": sum(w.alive for w in self._workers),
+                "ready": sum(w.ready for w in self._workers),
+                "in_flight": sum(len(w.jobs) for w in self._workers),
+                "restarts": sum(w.restarts for w in self._workers),
+                "workers": [{"index": w.index, "device": w.device, "pid": w.process.pid if w.process else None,
+                             "alive": w.alive, "ready": w.ready, "error": w.error, "models": sorted(w.models),
+                             "in_flight": len(w.jobs), "served": w.served, "restarts": w.restarts,
+                             "uptime_s": int(time.time() - w.started_at) if w.process else 0}
+                            for w in self._workers],
+                "sessions": len(self._sessions),
+            }
+
+
+worker_pool = WorkerPool(settings.model_workers, settings.worker_devices, settings.worker_models)
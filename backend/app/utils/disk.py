@@ -0,0 +1,26 @@
+﻿import os
+
+
+def trim_dir(path: str, suffix: str, budget_bytes: int):
+    """Deletes the least recently used `suffix` files in `path` until the rest fit `budget_bytes`.
+
+    Recency is the file's mtime, which the caches refresh on every disk hit.
+    """
+    files = []
+    for name in os.listdir(path):
+        if name.endswith(suffix):
+            p = os.path.join(path, name)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in files)
+    for _, size, p in sorted(files):
+        if total <= budget_bytes:
+            break
+        try:
+            os.remove(p)
+            total -= size
+        except OSError:
+            pass
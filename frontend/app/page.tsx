@@ -61,6 +61,7 @@ export default function Page() {
   const [loading, setLoading] = useState(false);
   const fileRef = useRef<HTMLInputElement>(null);
   const scrollerRef = useRef<HTMLDivElement>(null);
+  const sessionId = useRef<string>("");
 
   // autoscroll
   useEffect(() => {
@@ -136,6 +137,8 @@ export default function Page() {
       form.append("use_cpu", "false");
       form.append("max_image_edge", "1024");
       form.append("max_new_tokens", "512");
+      if (!sessionId.current) sessionId.current = crypto.randomUUID();
+      form.append("session_id", sessionId.current);
       filesToSend.forEach(f => form.append("files", f));
 
       const res = await fetch("http://127.0.0.1:8000/api/v1/chat/stream", { method: "POST", body: form });